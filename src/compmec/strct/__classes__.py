@@ -1,5 +1,5 @@
 class Point(object):
-    pass
+    __slots__ = ()
 
 
 class Profile(object):
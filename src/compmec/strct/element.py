@@ -2,7 +2,8 @@
 Each point has 6 unknowns:
 
 """
-from typing import Callable, Tuple, Union
+
+from typing import Callable, Optional, Tuple, Union
 
 import compmec.nurbs as nurbs
 import numpy as np
@@ -15,40 +16,70 @@ from compmec.strct.__classes__ import (
     Profile,
     Section,
 )
-from compmec.strct.geometry import Point3D
+from compmec.strct.geometry import Point3D, PointArray
 from compmec.strct.section import create_section_from_material_profile
 
 
-def compute_rvw(p0: Point3D, p1: Point3D) -> np.ndarray:
-    np0 = np.zeros(3)
-    np1 = np.zeros(3)
-    np0[: len(p0)] = p0
-    np1[: len(p1)] = p1
-    dp = np.array(np1 - np0)
-    L = np.linalg.norm(dp)
-    r = dp / L
-    v = (0, 0, 1)
-    cosangle = np.inner(r, v)
-    if np.abs(cosangle) > 0.99:  # 0.99 is the cos of 8 degrees
-        v = (0, 1, 0)
-        cosangle = np.inner(r, v)
-    v -= cosangle * r
-    v /= np.linalg.norm(v)
+def compute_frames(
+    p0s: np.ndarray, p1s: np.ndarray, reference: Union[None, np.ndarray] = None
+) -> np.ndarray:
+    """
+    Computes the local frames [r, w, v] of many segments at once.
+    The direction r goes from p0 to p1 and v is the reference vector
+    made perpendicular to r. If no reference is given, it's (0, 0, 1),
+    or (0, 1, 0) for the segments almost parallel to z.
+    The reference can be one vector for all segments or one per segment.
+    Returns an array of shape (n, 3, 3), each one a rotation matrix
+    """
+    p0s = np.array(p0s, dtype="float64")
+    p1s = np.array(p1s, dtype="float64")
+    npts = len(p0s)
+    np0s = np.zeros((npts, 3))
+    np1s = np.zeros((npts, 3))
+    np0s[:, : p0s.shape[1]] = p0s
+    np1s[:, : p1s.shape[1]] = p1s
+    dps = np1s - np0s
+    r = dps / np.linalg.norm(dps, axis=1)[:, None]
+    if reference is None:
+        v = np.zeros((npts, 3))
+        vertical = np.abs(r[:, 2]) > 0.99  # 0.99 is the cos of 8 degrees
+        v[~vertical, 2] = 1
+        v[vertical, 1] = 1
+    else:
+        v = np.array(np.broadcast_to(reference, (npts, 3)), dtype="float64")
+        v /= np.linalg.norm(v, axis=1)[:, None]
+    cosangle = np.einsum("ij,ij->i", r, v)
+    if reference is not None and np.any(np.abs(cosangle) > 1 - 1e-9):
+        error_msg = "The reference vector must not be parallel to the segment"
+        raise ValueError(error_msg)
+    v -= cosangle[:, None] * r
+    v /= np.linalg.norm(v, axis=1)[:, None]
     w = np.cross(v, r)
-    R = np.zeros((3, 3))
-    R[:, 0] = r
-    R[:, 1] = w
-    R[:, 2] = v
-    return R.T
+    return np.stack([r, w, v], axis=1)
+
+
+def compute_rvw(
+    p0: Point3D, p1: Point3D, reference: Union[None, np.ndarray] = None
+) -> np.ndarray:
+    return compute_frames([p0], [p1], reference)[0]
+
+
+def rotate_stiffness_matrices(Klocs: np.ndarray, R33s: np.ndarray) -> np.ndarray:
+    """
+    Changes the stiffness matrices of shape (n, 2, 6, 2, 6) from the local
+    basis of each segment to the global basis. Each 3x3 block of
+    displacements or rotations is transformed by R.T @ block @ R
+    """
+    n = len(Klocs)
+    Klocs = np.reshape(Klocs, (n, 2, 2, 3, 2, 2, 3))
+    Kglos = np.einsum("npq,niapjbr,nrt->niaqjbt", R33s, Klocs, R33s)
+    return Kglos.reshape((n, 2, 6, 2, 6))
 
 
 def init_from_tuple_points(points: Tuple[Point3D]):
     if not isinstance(points, (list, tuple, np.ndarray)):
         raise TypeError("Points must be list/tuple/numpy array")
-    points = list(points)
-    for i, pi in enumerate(points):
-        points[i] = Point3D(pi)
-    points = np.array(points, dtype="float64")
+    points = PointArray(points).coords
     degree, npts = 1, len(points)
     knotvector = nurbs.GeneratorKnotVector.uniform(degree, npts)
     return nurbs.SplineCurve(knotvector, points)
@@ -56,10 +87,10 @@ def init_from_tuple_points(points: Tuple[Point3D]):
 
 class Structural1D(Element1D):
     def __init__(self, path: Union[nurbs.SplineCurve, Tuple[Point]]):
-        if isinstance(path, nurbs.SplineCurve):
-            self._path = path
-            return
-        self._path = init_from_tuple_points(path)
+        self._reference = None
+        self.__stiffness = None
+        self.__nodes = None
+        self.path = path
 
     @property
     def field(self) -> Callable[[str], nurbs.SplineCurve]:
@@ -86,15 +117,30 @@ class Structural1D(Element1D):
     def path(self) -> nurbs.SplineCurve:
         return self._path
 
+    @path.setter
+    def path(self, value: Union[nurbs.SplineCurve, Tuple[Point]]):
+        if not isinstance(value, nurbs.SplineCurve):
+            value = init_from_tuple_points(value)
+        self._path = value
+        self.__stiffness = None
+        self.__nodes = None
+
     @property
     def section(self) -> Section:
         return self._section
 
     @section.setter
     def section(self, value: Union[Section, Tuple[Material, Profile]]):
+        self._section = self.create_section(value)
+        self.__stiffness = None
+
+    @staticmethod
+    def create_section(value: Union[Section, Tuple[Material, Profile]]) -> Section:
+        """
+        Gives the section from a <Section> or a pair (<Material>, <Profile>)
+        """
         if isinstance(value, Section):
-            self._section = value
-            return
+            return value
         if not isinstance(value, (tuple, list)):
             error_msg = "The section must be <Section>"
             error_msg += " or (<Material>, <Profile>)."
@@ -106,71 +152,161 @@ class Structural1D(Element1D):
             error_msg += f" Received {str(value)[:400]}"
             raise ValueError(error_msg)
         material, profile = value
-        value = create_section_from_material_profile(material, profile)
-        self._section = value
+        return create_section_from_material_profile(material, profile)
+
+    @property
+    def reference(self) -> Union[None, np.ndarray]:
+        """
+        The vector which gives the local v direction of the segments.
+        If None, it's chosen by ``compute_frames``
+        """
+        return self._reference
 
+    @reference.setter
+    def reference(self, value: Union[None, Tuple[float]]):
+        if value is None:
+            self._reference = None
+            self.__stiffness = None
+            return
+        if not isinstance(value, (tuple, list, np.ndarray)):
+            error_msg = "The reference must be a vector of 3 values."
+            error_msg += f" Received type = {type(value)}"
+            raise TypeError(error_msg)
+        value = np.array(value, dtype="float64")
+        if value.shape != (3,) or np.linalg.norm(value) == 0:
+            error_msg = "The reference must be a non-zero vector of 3 values."
+            error_msg += f" Received {str(value)[:400]}"
+            raise ValueError(error_msg)
+        self._reference = value
+        self.__stiffness = None
+
+    @property
+    def nodes(self) -> np.ndarray:
+        """
+        The positions of the path at the knots ``ts``, as a read-only
+        array of shape (nknots, ndim). They are evaluated all at once
+        and kept until the path changes
+        """
+        if self.__nodes is not None:
+            key, nodes = self.__nodes
+            if key == self.__geometry_key():
+                return nodes
+        path = self.path
+        if path.degree == 1 and path.npts == len(self.ts):
+            nodes = np.array(path.ctrlpoints, dtype="float64")
+        else:
+            nodes = np.array(path(self.ts), dtype="float64")
+        nodes.setflags(write=False)
+        self.__nodes = (self.__geometry_key(), nodes)
+        return nodes
+
+    def frames(self) -> np.ndarray:
+        """
+        Gives the local frame [r, w, v] of each segment between two knots.
+        Returns an array of shape (nsegments, 3, 3)
+        """
+        points = self.nodes
+        return compute_frames(points[:-1], points[1:], self.reference)
+
+    def local_stiffness_matrices(
+        self, lengths: np.ndarray, section: Optional[Section] = None
+    ) -> np.ndarray:
+        """
+        Gives the local stiffness matrix of each segment, from its length.
+        If ``section`` is not given, the element's section is used.
+        Returns an array of shape (nsegments, 2, 6, 2, 6)
+        """
+        raise NotImplementedError
 
-class Truss(Structural1D):
     def local_stiffness_matrix(self, p0: Point3D, p1: Point3D) -> np.ndarray:
         p0 = np.array(p0, dtype="float64")
         p1 = np.array(p1, dtype="float64")
         L = np.linalg.norm(p1 - p0)
-        E = self.section.material.E
-        A = self.section.A[0]
-        K = np.zeros((2, 6, 2, 6), dtype="float64")
-        K[:, 0, :, 0] = (E * A / L) * (2 * np.eye(2, dtype="float64") - 1)
-        return K
+        return self.local_stiffness_matrices(np.array([L]))[0]
 
     def global_stiffness_matrix(self, p0: Point3D, p1: Point3D) -> np.ndarray:
         Kloc = self.local_stiffness_matrix(p0, p1)
-        R33 = compute_rvw(p0, p1)
-        Kglo = np.zeros((2, 6, 2, 6), dtype="float64")
-        for i in range(2):
-            for j in range(2):
-                Kglo[i, :3, j, :3] = R33.T @ Kloc[i, :3, j, :3] @ R33
-                Kglo[i, :3, j, 3:] = R33.T @ Kloc[i, :3, j, 3:] @ R33
-                Kglo[i, 3:, j, :3] = R33.T @ Kloc[i, 3:, j, :3] @ R33
-                Kglo[i, 3:, j, 3:] = R33.T @ Kloc[i, 3:, j, 3:] @ R33
-        return Kglo
-
-    def stiffness_matrix(self) -> np.ndarray:
-        points = [self.path(ti) for ti in self.ts]
-        npts = len(points)
-        Kglobal = np.zeros((npts, 6, npts, 6))
-        for i in range(npts - 1):
-            p0, p1 = points[i], points[i + 1]
-            Kgloone = self.global_stiffness_matrix(p0, p1)
-            Kglobal[i : i + 2, :, i : i + 2, :] += Kgloone
-        return Kglobal
+        R33 = compute_rvw(p0, p1, self.reference)
+        return rotate_stiffness_matrices(Kloc[None], R33[None])[0]
 
+    def __geometry_key(self) -> Tuple:
+        path = self.path
+        ctrlpoints = np.array(path.ctrlpoints, dtype="float64")
+        weights = getattr(path, "weights", None)
+        if weights is not None:
+            weights = tuple(weights)
+        return (tuple(path.knotvector), ctrlpoints.shape, ctrlpoints.tobytes(), weights)
 
-class Beam(Structural1D):
-    def local_stiffness_matrix(self, p0: Point3D, p1: Point3D) -> np.ndarray:
-        raise NotImplementedError
+    def segment_stiffness_matrices(
+        self, section: Union[None, Section, Tuple[Material, Profile]] = None
+    ) -> np.ndarray:
+        """
+        Gives the global stiffness matrix of each segment between two
+        knots, all computed at once. Returns a read-only array of shape
+        (nsegments, 2, 6, 2, 6)
+        The result is kept until the section, the reference or the
+        path changes, so calling it again after the solve costs nothing.
+        If another ``section`` is given, the matrices are computed with
+        it, without changing the element nor the kept result
+        """
+        points = self.nodes
+        if section is not None:
+            section = self.create_section(section)
+            if section is not self.section:
+                return self.__segment_stiffness_matrices(points, section)
+        key = self.__geometry_key()
+        if self.__stiffness is not None:
+            oldsection, oldkey, Ksegs = self.__stiffness
+            if oldsection is self.section and oldkey == key:
+                return Ksegs
+        Ksegs = self.__segment_stiffness_matrices(points, self.section)
+        self.__stiffness = (self.section, key, Ksegs)
+        return Ksegs
 
-    def global_stiffness_matrix(self, p0: Point3D, p1: Point3D) -> np.ndarray:
-        Kloc = self.local_stiffness_matrix(p0, p1)
-        R33 = compute_rvw(p0, p1)
-        Kglo = np.zeros((2, 6, 2, 6), dtype="float64")
-        for i in range(2):
-            for j in range(2):
-                Kglo[i, :3, j, :3] = R33.T @ Kloc[i, :3, j, :3] @ R33
-                Kglo[i, :3, j, 3:] = R33.T @ Kloc[i, :3, j, 3:] @ R33
-                Kglo[i, 3:, j, :3] = R33.T @ Kloc[i, 3:, j, :3] @ R33
-                Kglo[i, 3:, j, 3:] = R33.T @ Kloc[i, 3:, j, 3:] @ R33
-        return Kglo
-
-    def stiffness_matrix(self) -> np.ndarray:
-        points = [self.path(ti) for ti in self.ts]
-        npts = len(points)
-        Kglobal = np.zeros((npts, 6, npts, 6))
-        for i in range(npts - 1):
-            p0, p1 = points[i], points[i + 1]
-            Kgloone = self.global_stiffness_matrix(p0, p1)
-            Kglobal[i : i + 2, :, i : i + 2, :] += Kgloone
+    def __segment_stiffness_matrices(
+        self, points: np.ndarray, section: Section
+    ) -> np.ndarray:
+        p0s, p1s = points[:-1], points[1:]
+        lengths = np.linalg.norm(p1s - p0s, axis=1)
+        Klocs = self.local_stiffness_matrices(lengths, section)
+        R33s = compute_frames(p0s, p1s, self.reference)
+        Ksegs = rotate_stiffness_matrices(Klocs, R33s)
+        Ksegs.setflags(write=False)
+        return Ksegs
+
+    def stiffness_matrix(
+        self, section: Union[None, Section, Tuple[Material, Profile]] = None
+    ) -> np.ndarray:
+        Ksegs = self.segment_stiffness_matrices(section)
+        nsegs = len(Ksegs)
+        Kglobal = np.zeros((nsegs + 1, 6, nsegs + 1, 6))
+        segs = np.arange(nsegs)
+        Kglobal[segs, :, segs, :] += Ksegs[:, 0, :, 0, :]
+        Kglobal[segs + 1, :, segs + 1, :] += Ksegs[:, 1, :, 1, :]
+        Kglobal[segs, :, segs + 1, :] += Ksegs[:, 0, :, 1, :]
+        Kglobal[segs + 1, :, segs, :] += Ksegs[:, 1, :, 0, :]
         return Kglobal
 
 
+class Truss(Structural1D):
+    def local_stiffness_matrices(
+        self, lengths: np.ndarray, section: Optional[Section] = None
+    ) -> np.ndarray:
+        if section is None:
+            section = self.section
+        E = section.material.E
+        A = section.A[0]
+        lengths = np.array(lengths, dtype="float64")
+        K = np.zeros((len(lengths), 2, 6, 2, 6), dtype="float64")
+        unit = 2 * np.eye(2, dtype="float64") - 1
+        K[:, :, 0, :, 0] = np.multiply.outer(E * A / lengths, unit)
+        return K
+
+
+class Beam(Structural1D):
+    pass
+
+
 class EulerBernoulli(Beam):
     def local_stiffness_matrix_Kx(self, L: float) -> np.ndarray:
         E = self.section.material.E
@@ -212,31 +348,46 @@ class EulerBernoulli(Beam):
         )
         return (E * Iy / L**3) * Kz
 
-    def local_stiffness_matrix(self, p0: Point3D, p1: Point3D) -> np.ndarray:
+    def local_stiffness_matrices(
+        self, lengths: np.ndarray, section: Optional[Section] = None
+    ) -> np.ndarray:
         """
         With two points we will have a matrix [12 x 12]
         But we are going to divide the matrix into [x, y, z] coordinates
         That means, our matrix is in fact [4, 3, 4, 3]
         Or also  [2, 6, 2, 6]
+        The matrices of all the segments are computed at once,
+        the result has shape (nsegments, 2, 6, 2, 6)
         """
-        p0 = np.array(p0, dtype="float64")
-        p1 = np.array(p1, dtype="float64")
-        L = np.linalg.norm(p1 - p0)
-        Kx = self.local_stiffness_matrix_Kx(L)
-        Kt = self.local_stiffness_matrix_Kt(L)
-        Ky = self.local_stiffness_matrix_Ky(L)
-        Kz = self.local_stiffness_matrix_Kz(L)
-        K = np.zeros((2, 6, 2, 6), dtype="float64")
-        K[:, 0, :, 0] = Kx
-        K[:, 3, :, 3] = Kt
-        for i in range(2):
-            for j in range(2):
-                for wa, a in enumerate([1, 5]):
-                    for wb, b in enumerate([1, 5]):
-                        K[i, a, j, b] = Ky[2 * i + wa, 2 * j + wb]
-                for wa, a in enumerate([2, 4]):
-                    for wb, b in enumerate([2, 4]):
-                        K[i, a, j, b] = Kz[2 * i + wa, 2 * j + wb]
+        if section is None:
+            section = self.section
+        L = np.array(lengths, dtype="float64")
+        E = section.material.E
+        G = section.material.G
+        A = section.A[0]
+        Ix, Iy, Iz = section.I
+        unit = 2 * np.eye(2, dtype="float64") - 1
+        # Bending matrix, in the order (v0, theta0, v1, theta1)
+        # written as C0 + C1 * L + C2 * L**2
+        C0 = [[12, 0, -12, 0], [0, 0, 0, 0], [-12, 0, 12, 0], [0, 0, 0, 0]]
+        C1 = [[0, 6, 0, 6], [6, 0, -6, 0], [0, -6, 0, -6], [6, 0, -6, 0]]
+        C2 = [[0, 0, 0, 0], [0, 4, 0, 2], [0, 0, 0, 0], [0, 2, 0, 4]]
+        Kb = np.multiply.outer(L**0, C0)
+        Kb += np.multiply.outer(L, C1)
+        Kb += np.multiply.outer(L**2, C2)
+        Kb /= L[:, None, None] ** 3
+        signs = np.outer([1, -1, 1, -1], [1, -1, 1, -1])
+        Ky = (E * Iz * Kb).reshape((len(L), 2, 2, 2, 2))
+        Kz = (E * Iy * signs * Kb).reshape((len(L), 2, 2, 2, 2))
+        K = np.zeros((len(L), 2, 6, 2, 6), dtype="float64")
+        K[:, :, 0, :, 0] = np.multiply.outer(E * A / L, unit)
+        K[:, :, 3, :, 3] = np.multiply.outer(G * Ix / L, unit)
+        for wa, a in enumerate([1, 5]):
+            for wb, b in enumerate([1, 5]):
+                K[:, :, a, :, b] = Ky[:, :, wa, :, wb]
+        for wa, a in enumerate([2, 4]):
+            for wb, b in enumerate([2, 4]):
+                K[:, :, a, :, b] = Kz[:, :, wa, :, wb]
         return K
 
 
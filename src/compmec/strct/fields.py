@@ -1,9 +1,10 @@
 import abc
+from typing import Optional
 
 import compmec.nurbs as nurbs
 import numpy as np
 
-from compmec.strct.__classes__ import ComputeField, Element1D
+from compmec.strct.__classes__ import ComputeField, Element1D, Section
 
 
 class ComputeFieldInterface(ComputeField):
@@ -37,8 +38,18 @@ class ComputeFieldBeamInterface(ComputeFieldInterface):
 
 
 class ComputeFieldBeam(ComputeFieldBeamInterface):
-    def __init__(self, element: Element1D, ctrlpointsresult: np.ndarray):
+    def __init__(
+        self,
+        element: Element1D,
+        ctrlpointsresult: np.ndarray,
+        section: Optional[Section] = None,
+    ):
+        """
+        The forces are computed with ``section`` if given, like the
+        section of a variant, else with the section of the element
+        """
         super().__init__(element, ctrlpointsresult)
+        self._section = section
         self.NAME2FUNCTIONS = {
             "U": self.displacement,
             "p": self.position,
@@ -103,30 +114,28 @@ class ComputeFieldBeam(ComputeFieldBeamInterface):
         displacement = self._field("U")
         return original_position + displacement
 
-    def internalforce(self) -> nurbs.SplineCurve:
+    def __segment_forces(self) -> np.ndarray:
+        """
+        Gives the forces and momentums at the nodes of each segment,
+        computed with the stiffness matrices of all segments at once.
+        Returns an array of shape (nsegments, 2, 6)
+        """
         resultctrlpoints = self._curveresult.ctrlpoints
+        Ksegs = self._element.segment_stiffness_matrices(self._section)
+        URs = np.stack([resultctrlpoints[:-1], resultctrlpoints[1:]], axis=1)
+        return np.einsum("sijkl,skl->sij", Ksegs, URs)
+
+    def internalforce(self) -> nurbs.SplineCurve:
+        FMs = self.__segment_forces()
         ctrlpts = np.zeros((self._curveresult.npts, 3))
-        pairs = np.array(
-            [self._element.ts[:-1], self._element.ts[1:]], dtype="float64"
-        ).T
-        for i, (t0, t1) in enumerate(pairs):
-            p0, p1 = self._element.path(t0), self._element.path(t1)
-            KG = self._element.global_stiffness_matrix(p0, p1)
-            UR = resultctrlpoints[i : i + 2, :]
-            FM = np.einsum("ijkl,kl", KG, UR)
-            ctrlpts[i, :] = FM[0, :3]
+        ctrlpts[:-1] = FMs[:, 0, :3]
         # Now correct the first value
-        t0, t1 = pairs[0]
-        p0, p1 = self._element.path(t0), self._element.path(t1)
-        KG = self._element.global_stiffness_matrix(p0, p1)
-        UR = resultctrlpoints[0 : 0 + 2, :]
-        FM = np.einsum("ijkl,kl", KG, UR)
-        ctrlpts[0, :] -= FM[0, :3]
+        ctrlpts[0, :] -= FMs[0, 0, :3]
         curve = nurbs.SplineCurve(self._curveresult.knotvector, ctrlpts)
         return curve
 
     def externalforce(self) -> nurbs.SplineCurve:
-        K = self._element.stiffness_matrix()
+        K = self._element.stiffness_matrix(self._section)
         resultctrlpoints = self._curveresult.ctrlpoints
         FM = np.einsum("ijkl,kl", K, resultctrlpoints)
         ctrlpts = FM[:, :3]
@@ -134,28 +143,15 @@ class ComputeFieldBeam(ComputeFieldBeamInterface):
         return curve
 
     def internalmomentum(self) -> nurbs.SplineCurve:
-        resultctrlpoints = self._curveresult.ctrlpoints
+        FMs = self.__segment_forces()
         ctrlpts = np.zeros((self._curveresult.npts, 3))
-        pairs = np.array(
-            [self._element.ts[:-1], self._element.ts[1:]], dtype="float64"
-        ).T
-        for i, (t0, t1) in enumerate(pairs):
-            p0, p1 = self._element.path(t0), self._element.path(t1)
-            KG = self._element.global_stiffness_matrix(p0, p1)
-            UR = resultctrlpoints[i : i + 2, :]
-            FM = np.einsum("ijkl,kl", KG, UR)
-            ctrlpts[i, :] = FM[0, 3:]
-        t0, t1 = pairs[0]
-        p0, p1 = self._element.path(t0), self._element.path(t1)
-        KG = self._element.global_stiffness_matrix(p0, p1)
-        UR = resultctrlpoints[0:2, :]
-        FM = np.einsum("ijkl,kl", KG, UR)
-        ctrlpts[0, :] -= FM[0, 3:]
+        ctrlpts[:-1] = FMs[:, 0, 3:]
+        ctrlpts[0, :] -= FMs[0, 0, 3:]
         curve = nurbs.SplineCurve(self._curveresult.knotvector, ctrlpts)
         return curve
 
     def externalmomentum(self) -> nurbs.SplineCurve:
-        K = self._element.stiffness_matrix()
+        K = self._element.stiffness_matrix(self._section)
         resultctrlpoints = self._curveresult.ctrlpoints
         FM = np.einsum("ijkl,kl", K, resultctrlpoints)
         ctrlpts = FM[:, 3:]
@@ -1,11 +1,17 @@
-from typing import Tuple, Union
+import itertools
+import math
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
+from scipy import sparse, spatial
+from scipy.sparse import csgraph
 
 from compmec.strct.__classes__ import Point
 
 
 class PointBase(Point):
+    __slots__ = ()
+
     @staticmethod
     def validation_creation(point: Tuple[float]):
         if not isinstance(point, (list, tuple, np.ndarray)):
@@ -48,6 +54,8 @@ class PointBase(Point):
 
 
 class Point2D(PointBase, Tuple):
+    __slots__ = ()
+
     @staticmethod
     def validation_creation(point: Tuple[float]):
         PointBase.validation_creation(point)
@@ -62,9 +70,214 @@ class Point2D(PointBase, Tuple):
         return super(Point2D, cls).__new__(cls, tuple(point))
 
 
-class Point3D(PointBase, Tuple):
+class SpatialHash(object):
+    """
+    Voxel grid to find the points near to a given position.
+    The space is divided in cubes of side ``size``, and each point
+    keeps its index in the list of its cube. To search near points
+    only the cubes around the position are checked, instead of all.
+    The three indexs of a cube are packed in one integer key, using
+    21 bits for each. Far cubes may share a key, but the distance is
+    always checked, so they only give more candidates
+    """
+
+    BITS = 21
+    MASK = (1 << BITS) - 1
+
+    def __init__(self, size: float):
+        if not isinstance(size, (int, float)):
+            raise TypeError(f"The size must be a float, not {type(size)}")
+        if size <= 0:
+            raise ValueError(f"The size must be positive, received {size}")
+        self._size = size
+        self.clear()
+
+    def clear(self):
+        self._cells: Dict[int, List[int]] = {}
+        self._points: List[Tuple[float]] = []
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __getitem__(self, index: int) -> Tuple[float]:
+        return self._points[index]
+
+    def cell(self, point: Tuple[float]) -> Tuple[int, int, int]:
+        return tuple(math.floor(pi / self._size) for pi in point)
+
+    @classmethod
+    def key(cls, cell: Tuple[int, int, int]) -> int:
+        i, j, k = cell
+        bits, mask = cls.BITS, cls.MASK
+        return ((i & mask) << 2 * bits) | ((j & mask) << bits) | (k & mask)
+
+    @classmethod
+    def keys(cls, cells: np.ndarray) -> np.ndarray:
+        """
+        Same as ``key`` for an integer array of shape (n, 3)
+        """
+        cells = np.asarray(cells, dtype="int64") & cls.MASK
+        return (cells[:, 0] << 2 * cls.BITS) | (cells[:, 1] << cls.BITS) | cells[:, 2]
+
+    def insert(self, point: Tuple[float]) -> int:
+        """
+        Stores the point and returns its index, the number of points before
+        """
+        index = len(self._points)
+        self._points.append(point)
+        self._cells.setdefault(self.key(self.cell(point)), []).append(index)
+        return index
+
+    def insert_many(self, points: np.ndarray) -> np.ndarray:
+        """
+        Stores the points of an array of shape (n, 3), returns their indexs
+        """
+        start = len(self._points)
+        self._points += [tuple(point) for point in points.tolist()]
+        keys = self.keys(np.floor(points / self._size)).tolist()
+        for index, key in enumerate(keys, start):
+            self._cells.setdefault(key, []).append(index)
+        return np.arange(start, start + len(points))
+
+    def query(self, point: Tuple[float], radius: float) -> List[int]:
+        """
+        Gives the indexs of the stored points whose distance to the
+        given point is less than ``radius``, in crescent order
+        """
+        lower = self.cell([pi - radius for pi in point])
+        upper = self.cell([pi + radius for pi in point])
+        indexs = set()
+        for i in range(lower[0], upper[0] + 1):
+            for j in range(lower[1], upper[1] + 1):
+                for k in range(lower[2], upper[2] + 1):
+                    for index in self._cells.get(self.key((i, j, k)), ()):
+                        other = self._points[index]
+                        distance = sum([(pi - qi) ** 2 for pi, qi in zip(point, other)])
+                        if distance < radius**2:
+                            indexs.add(index)
+        return sorted(indexs)
+
+    def query_many(
+        self, points: np.ndarray, radius: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as ``query`` for each point of an array of shape (n, 3).
+        The cells of all the points are computed at once, and only the
+        stored points in these cells are compared, which is fast while
+        ``radius`` is not bigger than ``size``. Returns the pairs
+        (position in ``points``, index of the stored point) which are
+        closer than ``radius``
+        """
+        points = np.array(points, dtype="float64").reshape((-1, 3))
+        lower = np.floor((points - radius) / self._size).astype("int64")
+        upper = np.floor((points + radius) / self._size).astype("int64")
+        spans = upper - lower
+        positions, indexs = [], []
+        cells = self._cells
+        for offset in itertools.product(range(np.max(spans, initial=0) + 1), repeat=3):
+            ids = np.flatnonzero(np.all(spans >= offset, axis=1))
+            keys = self.keys(lower[ids] + offset).tolist()
+            for position, bucket in zip(ids.tolist(), map(cells.get, keys)):
+                if bucket:
+                    positions += [position] * len(bucket)
+                    indexs += bucket
+        positions = np.array(positions, dtype="int64")
+        indexs = np.array(indexs, dtype="int64")
+        if len(indexs) == 0:
+            return positions, indexs
+        others = np.array([self._points[index] for index in indexs.tolist()])
+        distances = np.linalg.norm(points[positions] - others, axis=1)
+        close = distances < radius
+        return positions[close], indexs[close]
+
+
+class PointRegistry(object):
+    """
+    Gives an index to each different point, in the order they are added.
+    Two points whose distance is less than ``tolerance`` are the same
+    point. Each system owns its registry, so its points are forgotten
+    together with the system, or by ``clear``
+    """
+
+    def __init__(self, tolerance: float = 1e-3):
+        self._spatial = SpatialHash(1)
+        self.tolerance = tolerance
+
+    def clear(self):
+        self._spatial.clear()
+
+    @property
+    def tolerance(self) -> float:
+        return self._tolerance
+
+    @tolerance.setter
+    def tolerance(self, value: float):
+        """
+        Changes the tolerance, keeping the index of the added points
+        """
+        if not isinstance(value, (int, float)):
+            raise TypeError(f"The tolerance must be a float, not {type(value)}")
+        if not value > 0:
+            raise ValueError(f"The tolerance must be positive, received {value}")
+        self._tolerance = value
+        points = self._spatial[:]
+        # Each search checks at most 2 cells in each direction
+        self._spatial = SpatialHash(2 * value)
+        for point in points:
+            self._spatial.insert(point)
+
+    def __len__(self) -> int:
+        return len(self._spatial)
+
+    def __getitem__(self, index: int) -> Tuple[float]:
+        return self._spatial[index]
+
+    def find(self, point: Tuple[float]) -> Union[int, None]:
+        """
+        Gives the index of the point, or None if it was not added.
+        If there are many points at the position, the index of the
+        same object is given, else it raises ValueError
+        """
+        indexs = self._spatial.query(point, self._tolerance)
+        if len(indexs) == 0:
+            return None
+        if len(indexs) > 1:
+            for index in indexs:
+                if self[index] is point:
+                    return index
+            raise ValueError("To get point, must have less than 2 points")
+        return indexs[0]
+
+    def add(self, point: Tuple[float]) -> int:
+        """
+        Adds the point, even if there's another at the same position
+        """
+        return self._spatial.insert(point)
+
+    def get_index(self, point: Tuple[float]) -> int:
+        index = self.find(point)
+        if index is None:
+            index = self.add(point)
+        return index
+
+    def get_indexs(self, points: np.ndarray) -> np.ndarray:
+        """
+        Same as ``get_index`` for each point of an array of shape (n, 3).
+        The given points must be far from each other
+        """
+        indexs = np.full(len(points), -1, dtype="int64")
+        positions, found = self._spatial.query_many(points, self._tolerance)
+        if np.any(np.bincount(positions, minlength=len(points)) > 1):
+            raise ValueError("To get point, must have less than 2 points")
+        indexs[positions] = found
+        new = indexs == -1
+        indexs[new] = self._spatial.insert_many(points[new])
+        return indexs
+
 
-    all_indexed_instances = []
+class Point3D(PointBase, Tuple):
+    __slots__ = ()
+    registry = PointRegistry()
 
     @staticmethod
     def validation_creation(point: Tuple[float]):
@@ -77,29 +290,15 @@ class Point3D(PointBase, Tuple):
         if isinstance(point, Point3D):
             return point
         Point3D.validation_creation(point)
-        self = super(Point3D, cls).__new__(cls, tuple(point))
-        self._femid = None
-        return self
-
-    def _find_index_within_tolerance(self, tolerance: float):
-        indexs = []
-        for i, point in enumerate(Point3D.all_indexed_instances):
-            distance = sum([(pi - qi) ** 2 for pi, qi in zip(self, point)])
-            if distance < tolerance:
-                indexs.append(i)
-        return indexs
+        return super(Point3D, cls).__new__(cls, tuple(point))
 
     @property
     def femid(self) -> int:
-        if self._femid is not None:
-            return self._femid
-        indexs = self._find_index_within_tolerance(1e-6)
-        if len(indexs) == 0:
-            return None
-        if len(indexs) > 1:
-            raise ValueError("To get point, must have less than 2 points")
-        self._femid = indexs[0]
-        return self._femid
+        """
+        Index of the point in ``Point3D.registry``, used when the points
+        are not inside a system. It's None if there's no point here
+        """
+        return Point3D.registry.find(self)
 
     def get_index(self):
         if self.femid is None:
@@ -107,19 +306,135 @@ class Point3D(PointBase, Tuple):
         return self.femid
 
     def new_index(self):
-        Point3D.all_indexed_instances.append(self)
-        self._femid = len(Point3D.all_indexed_instances) - 1
+        Point3D.registry.add(self)
+
+
+class PointArray(object):
+    """
+    Group of n points in the space, kept in one array of shape (n, 3).
+    The operations are made over all the points at once:
+        points = PointArray([(0, 0, 0), (1, 0, 0), (1, 1, 0)])
+        points + (0, 0, 1)  # Translates all the points
+        points == (1, 0, 0)  # array([False, True, False])
+    """
+
+    __slots__ = ("_coords",)
+    __array_ufunc__ = None  # numpy arrays give the operations to PointArray
+    __hash__ = None
+
+    def __init__(self, points: Union["PointArray", Tuple[Tuple[float]]]):
+        if isinstance(points, PointArray):
+            self._coords = points._coords
+            return
+        error_msg = "PointArray must be created from an array of floats"
+        try:
+            coords = np.asarray(points)
+        except (TypeError, ValueError):
+            raise TypeError(error_msg)
+        if coords.size and coords.dtype.kind not in "iuf":
+            raise TypeError(error_msg)
+        coords = np.array(coords, dtype="float64")
+        if coords.size == 0:
+            coords = coords.reshape((0, 3))
+        if coords.ndim != 2:
+            error_msg = "PointArray must be created from a list of points,"
+            error_msg += f" received shape {coords.shape}"
+            raise TypeError(error_msg)
+        if coords.shape[1] != 3:
+            error_msg = f"PointArray must have shape (n, 3), received {coords.shape}"
+            raise ValueError(error_msg)
+        coords.flags.writeable = False
+        self._coords = coords
+
+    @property
+    def coords(self) -> np.ndarray:
+        """
+        Read-only array of shape (n, 3)
+        """
+        return self._coords
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        if dtype is None:
+            return self._coords
+        return self._coords.astype(dtype)
+
+    def __len__(self) -> int:
+        return len(self._coords)
+
+    def __iter__(self):
+        for point in self._coords.tolist():
+            yield Point3D(point)
+
+    def __getitem__(self, index) -> Union[Point3D, "PointArray"]:
+        if isinstance(index, (int, np.integer)):
+            return Point3D(self._coords[index].tolist())
+        return self.__class__(self._coords[index])
+
+    def __add__(self, other: Tuple[float]) -> "PointArray":
+        return self.__class__(self._coords + np.asarray(other, dtype="float64"))
+
+    def __sub__(self, other: Tuple[float]) -> "PointArray":
+        return self.__class__(self._coords - np.asarray(other, dtype="float64"))
+
+    def __radd__(self, other: Tuple[float]) -> "PointArray":
+        return self.__class__(np.asarray(other, dtype="float64") + self._coords)
+
+    def __rsub__(self, other: Tuple[float]) -> "PointArray":
+        return self.__class__(np.asarray(other, dtype="float64") - self._coords)
+
+    def __eq__(self, other: Tuple[float]) -> np.ndarray:
+        try:
+            other = np.asarray(other, dtype="float64")
+            return np.all(self._coords == other, axis=-1)
+        except (TypeError, ValueError):
+            return np.zeros(len(self), dtype="bool")
+
+    def __ne__(self, other: Tuple[float]) -> np.ndarray:
+        return ~self.__eq__(other)
+
+    def norm(self) -> np.ndarray:
+        """
+        Gives the distance of each point to the origin
+        """
+        return np.linalg.norm(self._coords, axis=1)
 
 
 class Geometry1D(object):
-    def __init__(self):
+    def __init__(self, registry: Optional[PointRegistry] = None):
+        """
+        The ``registry`` gives the global index of each point, and it can be
+        shared with the loads and boundary conditions of a system.
+        If not given, the geometry uses its own registry
+        """
+        if registry is None:
+            registry = PointRegistry()
+        if not isinstance(registry, PointRegistry):
+            error_msg = f"The registry must be a PointRegistry, not {type(registry)}"
+            raise TypeError(error_msg)
+        self._registry = registry
+        self.clear()
+
+    def clear(self):
+        """
+        Removes all the points of the geometry, keeping the registry
+        """
         self._global_indexs = []
+        self._local_indexs: Dict[int, int] = {}
+        self._lookup = None
+        self._coords = np.zeros((16, 3), dtype="float64")
 
     @property
-    def points(self):
-        instances = Point3D.all_indexed_instances
-        all_local_points = [instances[index] for index in self._global_indexs]
-        return np.array(all_local_points)
+    def registry(self) -> PointRegistry:
+        return self._registry
+
+    @property
+    def points(self) -> np.ndarray:
+        """
+        Read-only view of the coordinates, of shape (npts, 3)
+        """
+        points = self._coords[: self.npts]
+        points.flags.writeable = False
+        return points
 
     @property
     def npts(self):
@@ -131,12 +446,15 @@ class Geometry1D(object):
         return True
 
     def find_point(
-        self, point: Tuple[float], tolerance: float = 1e-6
+        self, point: Tuple[float], tolerance: Optional[float] = None
     ) -> Union[int, None]:
         """
         Given a point like (0.1, 3.1, 5), it returns the index of this point.
-        If the point is too far (bigger than tolerance), it returns None
+        If the point is too far (bigger than tolerance), it returns None.
+        If not given, the tolerance is the same of the registry
         """
+        if tolerance is None:
+            tolerance = self._registry.tolerance
         if not isinstance(tolerance, (int, float)):
             raise TypeError("Tolerance to find point must be a float")
         if tolerance <= 0:
@@ -150,8 +468,7 @@ class Geometry1D(object):
         """
         Internal unprotected function. See docs of the original function
         """
-        distances = [sum((pi - point) ** 2) for pi in self.points]
-        distsquare = np.array(distances, dtype="float64")
+        distsquare = np.sum((self.points - point) ** 2, axis=1)
         mindistsquare = np.min(distsquare)
         if np.all(mindistsquare > tolerance**2):
             return None
@@ -170,10 +487,99 @@ class Geometry1D(object):
         return self._add_point(point)
 
     def _add_point(self, point: Point3D) -> int:
-        global_index = point.get_index()
-        if global_index in self._global_indexs:
-            local_index = self._global_indexs.index(global_index)
-        else:
-            self._global_indexs.append(global_index)
-            local_index = len(self._global_indexs) - 1
+        global_index = self._registry.get_index(point)
+        if global_index in self._local_indexs:
+            return self._local_indexs[global_index]
+        local_index = len(self._global_indexs)
+        self.__reserve(local_index + 1)
+        self._coords[local_index] = point
+        self._global_indexs.append(global_index)
+        self._local_indexs[global_index] = local_index
+        self._lookup = None
         return local_index
+
+    def local_indexs(self, global_indexs: Tuple[int]) -> np.ndarray:
+        """
+        Gives the local index of each point from its index in the registry.
+        Raises ValueError if some point is not in the geometry
+        """
+        global_indexs = np.array(global_indexs, dtype="int64")
+        if self._lookup is None:
+            size = max(self._global_indexs, default=-1) + 1
+            self._lookup = np.full(size, -1, dtype="int64")
+            self._lookup[self._global_indexs] = np.arange(self.npts)
+        inside = (0 <= global_indexs) & (global_indexs < len(self._lookup))
+        local_indexs = np.full(global_indexs.shape, -1, dtype="int64")
+        local_indexs[inside] = self._lookup[global_indexs[inside]]
+        if np.any(local_indexs == -1):
+            raise ValueError("There are points which are not in the geometry")
+        return local_indexs
+
+    def __reserve(self, npts: int):
+        """
+        Grows the buffer of coordinates, at least doubling its size,
+        until it can keep ``npts`` points
+        """
+        if npts > len(self._coords):
+            size = max(npts, 2 * len(self._coords))
+            coords = np.zeros((size, 3), dtype="float64")
+            coords[: self.npts] = self._coords[: self.npts]
+            self._coords = coords
+
+    def add_points(self, points: np.ndarray) -> np.ndarray:
+        """
+        Adds many points at once, given by an array of shape (n, 3).
+        The points closer than the tolerance of the registry are merged
+        into one node, also with the points already in the geometry.
+        Returns the local index of each given point
+        """
+        try:
+            points = np.array(points, dtype="float64")
+        except (TypeError, ValueError):
+            raise TypeError("The points must be an array of floats")
+        if points.ndim != 2 or points.shape[1] != 3:
+            error_msg = f"The points must have shape (n, 3), received {points.shape}"
+            raise ValueError(error_msg)
+        if not np.all(np.isfinite(points)):
+            raise ValueError("The coordinates of the points must be finite")
+        npts = len(points)
+        radius = self._registry.tolerance
+        pairs = spatial.cKDTree(points).query_pairs(radius, output_type="ndarray")
+        if len(pairs) == 0:
+            nnodes, labels = npts, np.arange(npts)
+        else:
+            ones = np.ones(len(pairs), dtype="int8")
+            shape = (npts, npts)
+            graph = sparse.coo_matrix((ones, (pairs[:, 0], pairs[:, 1])), shape)
+            nnodes, labels = csgraph.connected_components(graph, directed=False)
+        firsts = np.sort(np.unique(labels, return_index=True)[1])
+        self.__reserve(self.npts + nnodes)
+        local_indexs = self._local_indexs
+        global_indexs = self._registry.get_indexs(points[firsts]).tolist()
+        news = []
+        for i, global_index in enumerate(global_indexs):
+            if global_index not in local_indexs:
+                local_indexs[global_index] = len(local_indexs)
+                news.append(i)
+                self._global_indexs.append(global_index)
+        news = np.array(news, dtype="int64")
+        self._coords[self.npts - len(news) : self.npts] = points[firsts[news]]
+        self._lookup = None
+        node_indexs = np.zeros(nnodes, dtype="int64")
+        node_indexs[labels[firsts]] = [local_indexs[glob] for glob in global_indexs]
+        return node_indexs[labels]
+
+    def renumber(self, permutation: Tuple[int]):
+        """
+        Changes the order of the points inside the geometry.
+        The point of local index ``permutation[i]`` receives the index ``i``
+        """
+        permutation = np.array(permutation, dtype="int64")
+        if permutation.ndim != 1 or len(permutation) != self.npts:
+            raise ValueError(f"Permutation must have {self.npts} indexs")
+        if np.any(np.sort(permutation) != np.arange(self.npts)):
+            raise ValueError("Received indexs are not a permutation")
+        self._global_indexs = [self._global_indexs[i] for i in permutation]
+        self._local_indexs = {glob: loc for loc, glob in enumerate(self._global_indexs)}
+        self._lookup = None
+        self._coords[: self.npts] = self._coords[permutation]
@@ -1,10 +1,10 @@
-from typing import Iterable, Optional
+from typing import Iterable, Optional, Union
 
 import matplotlib as mpl
 import numpy as np
 
 from compmec.strct.__classes__ import Shower, System
-from compmec.strct.geometry import Point2D, Point3D
+from compmec.strct.geometry import Point2D, Point3D, PointArray
 
 
 class AxonometricProjector(object):
@@ -35,12 +35,21 @@ class AxonometricProjector(object):
         else:
             raise NotImplementedError
 
-    def __call__(self, point: Point3D) -> Point2D:
+    def __call__(self, point: Union[Point3D, PointArray]) -> Union[Point2D, np.ndarray]:
+        if isinstance(point, PointArray):
+            return self.project_array(point)
         point3D = Point3D(point)
         x = np.inner(point3D, self._horizontal)
         y = np.inner(point3D, self._vertical)
         return Point2D([x, y])
 
+    def project_array(self, points: PointArray) -> np.ndarray:
+        """
+        Projects all the points at once, giving an array of shape (n, 2)
+        """
+        axes = np.array([self._horizontal, self._vertical], dtype="float64")
+        return PointArray(points).coords @ axes.T
+
 
 class PerspectiveProjector(object):
 
@@ -122,14 +131,10 @@ class ShowerStaticSystem(Shower):
         self, tplot: Iterable[float], deformed: Optional[bool], projector: Projector
     ):
         all2Dpoints = []
-        npts = len(tplot)
         for element in self.__system._structure.elements:
             curve = element.field("d") if deformed else element.field("p")
-            element3Dpoints = curve.evaluate(tplot)
-            element2Dpoints = np.zeros((npts, 2))
-            for j, point3D in enumerate(element3Dpoints):
-                element2Dpoints[j] = projector(point3D)
-            all2Dpoints.append(element2Dpoints)
+            element3Dpoints = PointArray(curve.evaluate(tplot))
+            all2Dpoints.append(projector(element3Dpoints))
         return all2Dpoints
 
     def plot2D_notfield(
@@ -1,7 +1,13 @@
-from typing import Tuple
+import time
+import warnings
+from typing import Dict, Optional, Tuple, Union
 
 import numpy as np
 from numpy import linalg as la
+from scipy import linalg as scila
+from scipy import sparse
+from scipy.linalg import lapack
+from scipy.sparse import linalg as spla
 
 """
 In the end we have a linear system which is given by
@@ -9,40 +15,932 @@ In the end we have a linear system which is given by
 
 """
 
+# Below this number of unknowns the dense LAPACK solver is faster
+SPARSE_MINIMUM_SIZE = 300
+# Above this fraction of nonzero entries the matrix is treated as dense
+SPARSE_MAXIMUM_DENSITY = 0.1
+# The banded storage is used if it's at most this times the sparse storage
+BANDED_MAXIMUM_RATIO = 4
+# Mixed precision refinement stops if the residual doesn't decrease this much
+REFINEMENT_MINIMUM_DECREASE = 0.5
+REFINEMENT_MAXIMUM_ITERATIONS = 20
+
+
+def bandwidth(K: Union[np.ndarray, sparse.spmatrix]) -> int:
+    """
+    Returns the biggest distance |i-j| of a nonzero entry K[i, j]
+    """
+    if sparse.issparse(K):
+        K = sparse.coo_matrix(K)
+        rows, cols = K.row[K.data != 0], K.col[K.data != 0]
+    else:
+        rows, cols = np.nonzero(K)
+    if len(rows) == 0:
+        return 0
+    return int(np.max(np.abs(rows - cols)))
+
+
+def choose_backend(Kuu: Union[np.ndarray, sparse.spmatrix]) -> str:
+    """
+    Decides which backend is used to solve the free-free system Kuu.
+    Returns "banded" if Kuu is a big sparse matrix with a narrow band,
+    "sparse" if Kuu is a big sparse matrix, else "dense"
+    """
+    if not sparse.issparse(Kuu):
+        return "dense"
+    nunk = Kuu.shape[0]
+    if nunk < SPARSE_MINIMUM_SIZE:
+        return "dense"
+    if Kuu.nnz > SPARSE_MAXIMUM_DENSITY * nunk**2:
+        return "dense"
+    if (2 * bandwidth(Kuu) + 1) * nunk <= BANDED_MAXIMUM_RATIO * Kuu.nnz:
+        return "banded"
+    return "sparse"
+
+
+def banded_storage(Kuu: sparse.spmatrix, lower: int, upper: int) -> np.ndarray:
+    """
+    Stores the diagonals of Kuu in the LAPACK format:
+        ab[upper + i - j, j] = Kuu[i, j]
+    Only the entries with ``-upper <= i - j <= lower`` are kept
+    """
+    Kuu = sparse.coo_matrix(Kuu)
+    inside = (Kuu.col - Kuu.row <= upper) & (Kuu.row - Kuu.col <= lower)
+    rows, cols = Kuu.row[inside], Kuu.col[inside]
+    ab = np.zeros((lower + upper + 1, Kuu.shape[0]), dtype="float64")
+    np.add.at(ab, (upper + rows - cols, cols), Kuu.data[inside])
+    return ab
+
+
+def preconditioner_jacobi(Kuu: sparse.spmatrix) -> sparse.spmatrix:
+    """
+    Inverse of the diagonal of Kuu. Null diagonal values are ignored
+    """
+    diagonal = np.array(Kuu.diagonal(), dtype="float64")
+    inverse = np.zeros(diagonal.shape, dtype="float64")
+    nonzero = diagonal != 0
+    inverse[nonzero] = 1 / diagonal[nonzero]
+    return sparse.diags(inverse)
+
+
+def preconditioner_blockjacobi(
+    Kuu: sparse.spmatrix, groups: Optional[np.ndarray] = None
+) -> sparse.spmatrix:
+    """
+    Inverse of the block diagonal of Kuu. Each block is made by the
+    unknowns of the same node, given by the sorted array ``groups``.
+    The blocks are inverted at once with the pseudo-inverse
+    """
+    nunk = Kuu.shape[0]
+    if groups is None:
+        groups = np.arange(nunk) // 6
+    groups = np.array(groups)
+    _, starts, sizes = np.unique(groups, return_index=True, return_counts=True)
+    size = np.max(sizes)
+    blockof = np.repeat(np.arange(len(starts)), sizes)
+    position = np.arange(nunk) - starts[blockof]
+    Kuu = sparse.coo_matrix(Kuu)
+    inside = blockof[Kuu.row] == blockof[Kuu.col]
+    rows, cols = Kuu.row[inside], Kuu.col[inside]
+    blocks = np.zeros((len(starts), size, size), dtype="float64")
+    np.add.at(blocks, (blockof[rows], position[rows], position[cols]), Kuu.data[inside])
+    inverses = np.linalg.pinv(blocks)
+    valid = np.arange(size) < sizes[:, None]
+    valid = valid[:, :, None] & valid[:, None, :]
+    indexs = starts[:, None] + np.arange(size)
+    rows = np.broadcast_to(indexs[:, :, None], blocks.shape)[valid]
+    cols = np.broadcast_to(indexs[:, None, :], blocks.shape)[valid]
+    return sparse.csr_matrix((inverses[valid], (rows, cols)), shape=(nunk, nunk))
+
+
+def preconditioner_ilu(Kuu: sparse.spmatrix) -> spla.LinearOperator:
+    """
+    Incomplete LU factorization of Kuu.
+    Since scipy has no incomplete cholesky, it's used in its place
+    """
+    ilu = spla.spilu(sparse.csc_matrix(Kuu))
+    return spla.LinearOperator(Kuu.shape, ilu.solve)
+
+
+PRECONDITIONERS = {
+    "jacobi": preconditioner_jacobi,
+    "block-jacobi": preconditioner_blockjacobi,
+    "ilu": preconditioner_ilu,
+}
+
+
+def conjugate_gradient(
+    Kuu: sparse.spmatrix,
+    B: np.ndarray,
+    M: sparse.spmatrix,
+    TOLERANCE: float,
+    maxiter: int,
+) -> Tuple[np.ndarray, int]:
+    """
+    Internal function, see the docs of ``solve_cg``
+    """
+    X = np.zeros(B.shape, dtype="float64")
+    normB = np.linalg.norm(B)
+    if normB == 0:
+        return X, 0
+    R = np.copy(B)
+    Z = M @ R
+    P = np.copy(Z)
+    RZ = np.inner(R, Z)
+    for iteration in range(1, maxiter + 1):
+        KP = Kuu @ P
+        alpha = RZ / np.inner(P, KP)
+        X += alpha * P
+        R -= alpha * KP
+        if np.linalg.norm(R) <= TOLERANCE * normB:
+            return X, iteration
+        Z = M @ R
+        RZnew = np.inner(R, Z)
+        P *= RZnew / RZ
+        P += Z
+        RZ = RZnew
+    warnings.warn(f"Conjugate gradient did not converge in {maxiter} iterations")
+    return X, maxiter
+
+
+class Factorization(object):
+    """
+    Decomposes the free-free matrix Kuu once, so the method ``solve``
+    can be called many times with different right sides B, which can be
+    a vector of shape (nunk, ) or a matrix of shape (nunk, ncases).
+    The backends are
+        "dense": LU decomposition, or pseudo-inverse if singular.
+            If ``mixed_precision`` is True, the LU decomposition is made
+            in float32 and the solution is refined in float64
+        "sparse": sparse LU decomposition (SuperLU), or LSQR if singular
+        "banded": banded cholesky or banded LU decomposition
+        "cg": preconditioned conjugate gradient, nothing is decomposed
+    If backend is not given, it's chosen by ``choose_backend``
+    """
+
+    backends = ("dense", "sparse", "banded", "cg")
+
+    @classmethod
+    def _verify_backend(cls, backend: Optional[str]):
+        if backend is not None and backend not in cls.backends:
+            error_msg = f"backend must be in {cls.backends}. Received {backend}"
+            raise ValueError(error_msg)
+
+    @staticmethod
+    def _verify_preconditioner(preconditioner: str):
+        if preconditioner not in PRECONDITIONERS:
+            error_msg = f"preconditioner must be in {list(PRECONDITIONERS.keys())}."
+            error_msg += f" Received {preconditioner}"
+            raise ValueError(error_msg)
+
+    def __init__(
+        self,
+        Kuu: Union[np.ndarray, sparse.spmatrix],
+        TOLERANCE=1e-9,
+        backend: Optional[str] = None,
+        preconditioner: str = "block-jacobi",
+        maxiter: Optional[int] = None,
+        groups: Optional[np.ndarray] = None,
+        mixed_precision: bool = False,
+    ):
+        self._verify_backend(backend)
+        if backend == "cg":
+            self._verify_preconditioner(preconditioner)
+        if backend is None:
+            backend = choose_backend(Kuu)
+        self._backend = backend
+        self._TOLERANCE = TOLERANCE
+        self._nunk = Kuu.shape[0]
+        self._iterations = None
+        self._mixed_precision = False
+        self._leastsquare = False
+        self._norm = np.max(np.abs(Kuu).sum(axis=0)) if self._nunk else 0
+        if backend == "dense" and mixed_precision:
+            self.__factorize_mixed(Kuu)
+        elif backend == "dense":
+            self.__factorize_dense(Kuu)
+        elif backend == "sparse":
+            self.__factorize_sparse(Kuu)
+        elif backend == "banded":
+            self.__factorize_banded(Kuu)
+        else:
+            self.__factorize_cg(Kuu, preconditioner, maxiter, groups)
+
+    @property
+    def backend(self) -> str:
+        return self._backend
+
+    @property
+    def iterations(self) -> Union[int, None]:
+        """
+        Biggest number of iterations of the last call of ``solve``.
+        For mixed precision, it's the number of refinement steps.
+        It's None if the backend is not iterative
+        """
+        return self._iterations
+
+    @property
+    def mixed_precision(self) -> bool:
+        """
+        Tells if the solution comes from the float32 decomposition.
+        It becomes False when the refinement stalls and the matrix
+        is decomposed again in float64
+        """
+        return self._mixed_precision
+
+    @property
+    def leastsquare(self) -> bool:
+        """
+        Tells if Kuu is singular and the least square solution is used
+        """
+        return self._leastsquare
+
+    @property
+    def lowrank(self) -> Union[int, None]:
+        """
+        Rank of the correction applied over a previous decomposition.
+        It's None if Kuu was decomposed from scratch
+        """
+        return None
+
+    def condition(self) -> Union[float, None]:
+        """
+        Estimates the condition number in norm 1 of Kuu, using the
+        decomposition to apply the inverse of Kuu a few times.
+        Since Kuu is symmetric, the inverse is used as its transpose.
+        It's infinite if Kuu is singular and None for the "cg" backend
+        """
+        if self.backend == "cg":
+            return None
+        if self.leastsquare:
+            return float("inf")
+        if self._nunk == 0:
+            return 1.0
+        inverse = spla.LinearOperator(
+            (self._nunk, self._nunk),
+            matvec=self.solve,
+            rmatvec=self.solve,
+            matmat=self.solve,
+            dtype="float64",
+        )
+        iterations = self._iterations
+        estimate = self._norm * spla.onenormest(inverse)
+        self._iterations = iterations
+        return float(estimate)
+
+    def __factorize_dense(self, Kuu: np.ndarray):
+        if sparse.issparse(Kuu):
+            Kuu = Kuu.toarray()
+        Kuu = np.array(Kuu, dtype="float64")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", scila.LinAlgWarning)
+            lu, piv = scila.lu_factor(Kuu)
+        if np.all(np.diag(lu) != 0):
+            self._solve = lambda B: scila.lu_solve((lu, piv), B)
+            return
+        pseudoinverse = la.pinv(Kuu, rcond=self._TOLERANCE)
+        self._leastsquare = True
+        self._solve = lambda B: pseudoinverse @ B
+
+    def __factorize_mixed(self, Kuu: np.ndarray):
+        if sparse.issparse(Kuu):
+            Kuu = Kuu.toarray()
+        Kuu = np.array(Kuu, dtype="float64")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", scila.LinAlgWarning)
+            lu, piv = scila.lu_factor(Kuu.astype("float32"))
+        if not np.all(np.isfinite(lu)) or np.any(np.diag(lu) == 0):
+            self.__factorize_dense(Kuu)
+            return
+        self._mixed_precision = True
+        self._solve = lambda B: self.__refine(Kuu, (lu, piv), B)
+
+    def __refine(self, Kuu: np.ndarray, lupiv: Tuple, B: np.ndarray) -> np.ndarray:
+        """
+        Iterative refinement: the correction is computed with the float32
+        decomposition and the residual is computed in float64.
+        If the residual stalls, Kuu is decomposed again in float64
+        """
+        normB = np.linalg.norm(B, axis=0)
+        normB = np.where(normB == 0, 1, normB)
+        X = scila.lu_solve(lupiv, B.astype("float32")).astype("float64")
+        R = B - Kuu @ X
+        error = np.max(np.linalg.norm(R, axis=0) / normB)
+        for iteration in range(REFINEMENT_MAXIMUM_ITERATIONS):
+            if error <= self._TOLERANCE:
+                self._iterations = iteration
+                return X
+            X += scila.lu_solve(lupiv, R.astype("float32"))
+            R = B - Kuu @ X
+            newerror = np.max(np.linalg.norm(R, axis=0) / normB)
+            if newerror > REFINEMENT_MINIMUM_DECREASE * error:
+                break
+            error = newerror
+        self._mixed_precision = False
+        self._iterations = None
+        self.__factorize_dense(Kuu)
+        return self._solve(B)
+
+    def __factorize_sparse(self, Kuu: sparse.spmatrix):
+        Kuu = sparse.csc_matrix(Kuu)
+        try:
+            lu = spla.splu(Kuu)
+        except RuntimeError:
+            self._leastsquare = True
+            self._solve = lambda B: self.__lsqr(Kuu, B)
+            return
+        self._solve = lu.solve
+
+    def __lsqr(self, Kuu: sparse.spmatrix, B: np.ndarray) -> np.ndarray:
+        TOLERANCE = self._TOLERANCE
+        if B.ndim == 1:
+            return spla.lsqr(Kuu, B, atol=TOLERANCE, btol=TOLERANCE)[0]
+        X = np.zeros(B.shape, dtype="float64")
+        for j, Bj in enumerate(B.T):
+            X[:, j] = spla.lsqr(Kuu, Bj, atol=TOLERANCE, btol=TOLERANCE)[0]
+        return X
+
+    def __factorize_banded(self, Kuu: sparse.spmatrix):
+        Kuu = sparse.csr_matrix(Kuu)
+        band = bandwidth(Kuu)
+        asymmetry = abs(Kuu - Kuu.T).max() if Kuu.nnz else 0
+        if asymmetry <= self._TOLERANCE * abs(Kuu).max():
+            try:
+                cb = scila.cholesky_banded(banded_storage(Kuu, 0, band))
+                self._solve = lambda B: scila.cho_solve_banded((cb, False), B)
+                return
+            except np.linalg.LinAlgError:
+                pass
+        ab = banded_storage(Kuu, band, 2 * band)  # Extra space for LU
+        gbtrf, gbtrs = lapack.get_lapack_funcs(("gbtrf", "gbtrs"), (ab,))
+        lu, piv, info = gbtrf(ab, band, band)
+        if info != 0:
+            self.__factorize_sparse(Kuu)
+            return
+        self._solve = lambda B: gbtrs(lu, band, band, B, piv)[0]
+
+    def __factorize_cg(
+        self,
+        Kuu: sparse.spmatrix,
+        preconditioner: str,
+        maxiter: Optional[int],
+        groups: Optional[np.ndarray],
+    ):
+        Kuu = sparse.csr_matrix(Kuu)
+        if preconditioner == "block-jacobi":
+            M = preconditioner_blockjacobi(Kuu, groups)
+        else:
+            M = PRECONDITIONERS[preconditioner](Kuu)
+        if maxiter is None:
+            maxiter = 10 * Kuu.shape[0]
+
+        def solvecg(B: np.ndarray) -> np.ndarray:
+            if B.ndim == 1:
+                X, self._iterations = conjugate_gradient(
+                    Kuu, B, M, self._TOLERANCE, maxiter
+                )
+                return X
+            X = np.zeros(B.shape, dtype="float64")
+            self._iterations = 0
+            for j, Bj in enumerate(B.T):
+                X[:, j], niter = conjugate_gradient(
+                    Kuu, Bj, M, self._TOLERANCE, maxiter
+                )
+                self._iterations = max(self._iterations, niter)
+            return X
+
+        self._solve = solvecg
+
+    def solve(self, B: np.ndarray) -> np.ndarray:
+        B = np.array(B, dtype="float64")
+        if B.shape[0] != self._nunk:
+            error_msg = f"B must have {self._nunk} lines, received shape {B.shape}"
+            raise ValueError(error_msg)
+        if self._nunk == 0:
+            return np.copy(B)
+        return self._solve(B)
+
+
+def solve_dense(Kuu: np.ndarray, B: np.ndarray, TOLERANCE=1e-9) -> np.ndarray:
+    return Factorization(Kuu, TOLERANCE, "dense").solve(B)
+
+
+def solve_sparse(Kuu: sparse.spmatrix, B: np.ndarray, TOLERANCE=1e-9) -> np.ndarray:
+    """
+    Uses the sparse LU decomposition (SuperLU) with a fill-reducing
+    column ordering. If the matrix is singular, the least square
+    solution is found by the iterative LSQR method
+    """
+    return Factorization(Kuu, TOLERANCE, "sparse").solve(B)
+
+
+def solve_banded(Kuu: sparse.spmatrix, B: np.ndarray, TOLERANCE=1e-9) -> np.ndarray:
+    """
+    Stores only the diagonals of Kuu, which is efficient when the
+    nodes are numbered to have a small bandwidth.
+    Uses the banded cholesky decomposition if Kuu is symmetric
+    positive definite, else the banded LU decomposition.
+    If the matrix is singular, it uses the same fallback as 'solve_sparse'
+    """
+    return Factorization(Kuu, TOLERANCE, "banded").solve(B)
+
+
+def solve_cg(
+    Kuu: sparse.spmatrix,
+    B: np.ndarray,
+    TOLERANCE=1e-9,
+    preconditioner: str = "block-jacobi",
+    maxiter: Optional[int] = None,
+    groups: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, int]:
+    """
+    Preconditioned conjugate gradient for symmetric positive definite Kuu.
+    Iterates until the residual norm is below TOLERANCE times the norm of B,
+    or until ``maxiter`` iterations, which is ``10 * len(B)`` by default.
+    Returns the solution and the number of iterations.
+    The ``groups`` is the node of each unknown, used by "block-jacobi"
+    """
+    Factorization._verify_preconditioner(preconditioner)
+    factor = Factorization(Kuu, TOLERANCE, "cg", preconditioner, maxiter, groups)
+    X = factor.solve(B)
+    return X, factor.iterations
+
+
+class SolveReport(object):
+    """
+    Information about one call of ``solve``, to track the cost
+    and the numerical health of the solution:
+        backend: the backend used to solve Kuu
+        size: the number of unknowns, the size of Kuu
+        nnz: number of nonzero entries of Kuu
+        ncases: number of load cases solved
+        factorization_time: seconds spent to decompose Kuu
+        solve_time: seconds spent to find the solution with the decomposition
+        residual: biggest relative residual |Kuu @ Uu - B| / |B| of the cases,
+                  computed before the small displacements are clipped
+        condition: estimate of the condition number of Kuu in norm 1,
+                   None if it was not asked
+        leastsquare: if Kuu is singular and the least square solution was used
+        iterations: number of iterations of "cg" or of mixed precision
+        mixed_precision: if the solution comes from the float32 decomposition
+        nclipped: number of displacements below TOLERANCE set as zero
+        lowrank: rank of the update over a previous decomposition, or None
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.size = 0
+        self.nnz = 0
+        self.ncases = 0
+        self.factorization_time = 0.0
+        self.solve_time = 0.0
+        self.residual = 0.0
+        self.condition = None
+        self.leastsquare = False
+        self.iterations = None
+        self.mixed_precision = False
+        self.nclipped = 0
+        self.lowrank = None
+
+    def __str__(self) -> str:
+        lines = [f"{self.__class__.__name__}:"]
+        for key, value in self.__dict__.items():
+            lines.append(f"    {key}: {value}")
+        return "\n".join(lines)
+
+
+class Partition(object):
+    """
+    Splits the degrees of freedom into the ones with known displacement
+    (boundary conditions) and the unknown ones.
+    It's created once from a boolean array ``known`` of shape (npts, ndofs)
+    and its index arrays are reused by every solve
+    """
+
+    @classmethod
+    def from_values(cls, U: np.ndarray) -> "Partition":
+        """
+        Creates the partition from a matrix of displacements where the
+        unknown values are ``None`` (object array) or ``nan`` (float array)
+        """
+        U = np.array(U)
+        if U.dtype == object:
+            return cls(U != None)
+        return cls(~np.isnan(U.astype("float64")))
+
+    def __init__(self, known: np.ndarray):
+        known = np.array(known, dtype="bool")
+        if known.ndim != 2:
+            raise ValueError(f"known must be of shape (npts, ndofs), not {known.shape}")
+        self._shape = known.shape
+        self._known = np.flatnonzero(known)
+        self._unknown = np.flatnonzero(~known)
+
+    def __eq__(self, other: "Partition") -> bool:
+        if not isinstance(other, Partition):
+            return False
+        if self.shape != other.shape:
+            return False
+        return np.array_equal(self.known, other.known)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._shape
+
+    @property
+    def known(self) -> np.ndarray:
+        """
+        Flat indexs of the degrees of freedom with known displacement
+        """
+        return self._known
+
+    @property
+    def unknown(self) -> np.ndarray:
+        """
+        Flat indexs of the degrees of freedom with unknown displacement
+        """
+        return self._unknown
+
+    @property
+    def groups(self) -> np.ndarray:
+        """
+        The node of each unknown degree of freedom
+        """
+        return self._unknown // self._shape[1]
+
+    def split(
+        self, K: Union[np.ndarray, sparse.spmatrix]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Gathers the blocks (Kkk, Kku, Kuu) of the matrix K,
+        which is sparse of shape (npts*ndofs, npts*ndofs)
+        or dense of shape (npts, ndofs, npts, ndofs)
+        """
+        known, unknown = self._known, self._unknown
+        if sparse.issparse(K):
+            K = sparse.csr_matrix(K)
+            Kknown = K[known]
+            return Kknown[:, known], Kknown[:, unknown], K[unknown][:, unknown]
+        nvals = self._shape[0] * self._shape[1]
+        K = np.reshape(K, (nvals, nvals))
+        Kkk = K[np.ix_(known, known)]
+        Kku = K[np.ix_(known, unknown)]
+        Kuu = K[np.ix_(unknown, unknown)]
+        return Kkk, Kku, Kuu
+
+
+class LowRankUpdate(Factorization):
+    """
+    Reuses the decomposition of a base matrix A = Kuu0 to solve a new
+    system which differs from the base by few degrees of freedom:
+        * Stiffness changes (springs, sections) in the positions ``changed``
+          ΔA = P D P^T, solved by the Sherman-Morrison-Woodbury formula
+            (A + P D P^T)^{-1} = A^{-1} - Z D (I + P^T Z D)^{-1} P^T A^{-1}
+          with Z = A^{-1} P
+        * New supports in the positions ``fixed``, which have null
+          displacement imposed by a reaction r in the capacitance system
+            (E^T Ã^{-1} E) r = - E^T Ã^{-1} b
+    The new unknowns must be a subset of the base unknowns.
+    Construction costs ``len(changed) + len(fixed)`` solves with the base
+    decomposition, and each solve costs one solve with the base.
+    Raises ValueError if the correction is singular
+    """
+
+    def __init__(
+        self,
+        base: Factorization,
+        Kuu: Union[np.ndarray, sparse.spmatrix],
+        DeltaA: np.ndarray,
+        changed: np.ndarray,
+        fixed: np.ndarray,
+        positions: np.ndarray,
+    ):
+        self._base = base
+        self._backend = base.backend
+        self._TOLERANCE = base._TOLERANCE
+        self._nunk = len(positions)
+        self._iterations = base.iterations
+        self._mixed_precision = base.mixed_precision
+        self._leastsquare = base.leastsquare
+        self._norm = np.max(np.abs(Kuu).sum(axis=0)) if len(positions) else 0
+        self._changed = np.array(changed, dtype="int64")
+        self._fixed = np.array(fixed, dtype="int64")
+        self._positions = np.array(positions, dtype="int64")
+        nbase = base._nunk
+        self._D = np.array(DeltaA, dtype="float64")
+        if len(self._changed):
+            P = np.zeros((nbase, len(self._changed)), dtype="float64")
+            P[self._changed, np.arange(len(self._changed))] = 1
+            self._Z = base.solve(P)
+            C = np.eye(len(self._changed)) + self._Z[self._changed] @ self._D
+            self._luC = self.__small_factor(C)
+        if len(self._fixed):
+            E = np.zeros((nbase, len(self._fixed)), dtype="float64")
+            E[self._fixed, np.arange(len(self._fixed))] = 1
+            self._YE = self.__woodbury(E)
+            self._luS = self.__small_factor(self._YE[self._fixed])
+        self._solve = self.__solve
+
+    @property
+    def lowrank(self) -> int:
+        return len(self._changed) + len(self._fixed)
+
+    @staticmethod
+    def __small_factor(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", scila.LinAlgWarning)
+            lu, piv = scila.lu_factor(matrix)
+        if not np.all(np.isfinite(lu)) or np.any(np.diag(lu) == 0):
+            raise ValueError("The low rank correction is singular")
+        return lu, piv
+
+    def __woodbury(self, B: np.ndarray) -> np.ndarray:
+        Y = self._base.solve(B)
+        if len(self._changed):
+            correction = scila.lu_solve(self._luC, Y[self._changed])
+            Y -= self._Z @ (self._D @ correction)
+        return Y
+
+    def __solve(self, B: np.ndarray) -> np.ndarray:
+        Bbase = np.zeros((self._base._nunk,) + B.shape[1:], dtype="float64")
+        Bbase[self._positions] = B
+        Y = self.__woodbury(Bbase)
+        if len(self._fixed):
+            reaction = scila.lu_solve(self._luS, -Y[self._fixed])
+            Y += self._YE @ reaction
+        return Y[self._positions]
+
+
+class FactorizationCache(object):
+    """
+    Keeps the decomposition of the last Kuu, to be reused by the next
+    solves. If the new matrix is the same, nothing is decomposed. If it
+    differs by new supports and stiffness changes on at most ``maxrank``
+    degrees of freedom, a ``LowRankUpdate`` is used over the kept one.
+    Else the new matrix is decomposed and kept in the place of the old
+    """
+
+    def __init__(self, maxrank: int = 60):
+        if not isinstance(maxrank, int):
+            raise TypeError(f"maxrank must be an integer, not {type(maxrank)}")
+        if maxrank < 0:
+            raise ValueError(f"maxrank must be non-negative, received {maxrank}")
+        self._maxrank = maxrank
+        self.clear()
+
+    def clear(self):
+        self._factor = None
+        self._partition = None
+        self._Kuu = None
+        self._options = None
+
+    def __getstate__(self) -> Dict:
+        # The decompositions can't be pickled, they're made again
+        return {"maxrank": self._maxrank}
+
+    def __setstate__(self, state: Dict):
+        self._maxrank = state["maxrank"]
+        self.clear()
+
+    def factorize(
+        self,
+        K: Union[np.ndarray, sparse.spmatrix],
+        partition: Partition,
+        Kuu: Union[np.ndarray, sparse.spmatrix],
+        TOLERANCE=1e-9,
+        backend: Optional[str] = None,
+        preconditioner: str = "block-jacobi",
+        maxiter: Optional[int] = None,
+        mixed_precision: bool = False,
+    ) -> Factorization:
+        """
+        Gives the decomposition of Kuu, the free-free block of K
+        """
+        options = (TOLERANCE, backend, preconditioner, maxiter, mixed_precision)
+        if self._factor is not None and options == self._options:
+            update = self.__update(K, partition, Kuu)
+            if update is not None:
+                return update
+        groups = partition.groups
+        self._factor = Factorization(Kuu, TOLERANCE, *options[1:4], groups, options[4])
+        self._partition = partition
+        self._Kuu = sparse.csr_matrix(Kuu)
+        self._options = options
+        return self._factor
+
+    def __update(
+        self,
+        K: Union[np.ndarray, sparse.spmatrix],
+        partition: Partition,
+        Kuu: Union[np.ndarray, sparse.spmatrix],
+    ) -> Union[LowRankUpdate, None]:
+        base = self._factor
+        if base.backend == "cg" or base.leastsquare:
+            return None
+        if partition.shape != self._partition.shape:
+            return None
+        unknown0, unknown1 = self._partition.unknown, partition.unknown
+        if not np.all(np.isin(unknown1, unknown0)):
+            return None  # Released supports
+        positions = np.searchsorted(unknown0, unknown1)
+        fixed = np.setdiff1d(np.arange(len(unknown0)), positions)
+        if partition == self._partition:
+            Knew = sparse.csr_matrix(Kuu)
+        else:
+            Knew = sparse.csr_matrix(self._partition.split(K)[2])
+        DeltaK = sparse.coo_matrix(Knew - self._Kuu)
+        nonzero = DeltaK.data != 0
+        changed = np.union1d(DeltaK.row[nonzero], DeltaK.col[nonzero])
+        rank = len(changed) + len(fixed)
+        if rank > self._maxrank or 2 * rank > len(unknown0):
+            return None
+        DeltaA = sparse.csr_matrix(DeltaK)[changed][:, changed].toarray()
+        try:
+            return LowRankUpdate(base, Kuu, DeltaA, changed, fixed, positions)
+        except ValueError:
+            return None
+
 
 def solve(
-    K: np.ndarray, F: np.ndarray, U: np.ndarray, TOLERANCE=1e-9
+    K: Union[np.ndarray, sparse.spmatrix],
+    F: np.ndarray,
+    U: np.ndarray,
+    TOLERANCE=1e-9,
+    backend: Optional[str] = None,
+    preconditioner: str = "block-jacobi",
+    maxiter: Optional[int] = None,
+    full_output: bool = False,
+    partition: Optional[Partition] = None,
+    mixed_precision: bool = False,
+    cache: Optional[FactorizationCache] = None,
+    condition: bool = True,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """
     K is a big matrix of shape (npts, 6, npts, 6)
+        or a scipy sparse matrix of shape (npts*6, npts*6)
     F is a matrix of shape (npts, 6)
+        or (npts, 6, ncases) to solve many load cases at once
     U is a matrix of the values of U, of shape (npts, 6)
+    The unknown values are marked as ``nan``, or ``None`` for object arrays.
     That means, U is like
-    U = [[1, None, 0, None, None, None],
-         [None, 0, None, None, None, None],
+    U = [[1, nan, 0, nan, nan, nan],
+         [nan, 0, nan, nan, nan, nan],
          ...
          []]
+    If ``partition`` is given, it's used instead of searching the
+    unknown values in U, and only the known positions of U are read.
+    backend is "dense", "sparse", "banded" or "cg". If not given, it's chosen
+    by the size, sparsity and bandwidth of the matrix.
+    The "cg" backend is iterative, see ``solve_cg`` for the options
+    ``preconditioner`` and ``maxiter``.
+    If ``mixed_precision`` is True, the "dense" backend decomposes in float32
+    and refines the solution in float64 until the residual is below TOLERANCE.
+    If a ``cache`` is given, the decomposition of a previous call is reused
+    when possible, see ``FactorizationCache``.
+    If ``full_output`` is True, it also returns a ``SolveReport``.
+    The estimate of the condition number in the report costs a few more
+    solves with the decomposition, it's skipped if ``condition`` is False
     """
-    npts, ndofs = U.shape
-    Kexp = K.reshape((npts * ndofs, npts * ndofs))
-    Fexp = F.reshape((npts * ndofs)).astype("float64")
-    Uexp = U.reshape((npts * ndofs))
-    mask = Uexp == None
-    Uk = np.delete(Uexp, mask).astype("float64")
-    Fk = np.delete(Fexp, ~mask)
-    Kkk = np.delete(np.delete(Kexp, mask, axis=0), mask, axis=1)
-    Kku = np.delete(np.delete(Kexp, mask, axis=0), ~mask, axis=1)
-    Kuu = np.delete(np.delete(Kexp, ~mask, axis=0), ~mask, axis=1)
-
-    B = Fk - Kku.T @ Uk
-    try:
-        Uu = la.solve(Kuu, B)
-    except np.linalg.LinAlgError:
-        Uu = la.lstsq(Kuu, B, rcond=TOLERANCE)[0]
+    Factorization._verify_backend(backend)
+    if partition is None:
+        partition = Partition.from_values(U)
+    known, unknown = partition.known, partition.unknown
+    Fexp = np.reshape(F, (len(known) + len(unknown), -1)).astype("float64")
+    Uk = np.array(np.reshape(U, -1)[known], dtype="float64")
+    Kkk, Kku, Kuu = partition.split(K)
+
+    B = Fexp[unknown] - (Kku.T @ Uk)[:, None]
+    groups = partition.groups
+    start = time.perf_counter()
+    if cache is None:
+        factor = Factorization(
+            Kuu, TOLERANCE, backend, preconditioner, maxiter, groups, mixed_precision
+        )
+    else:
+        factor = cache.factorize(
+            K,
+            partition,
+            Kuu,
+            TOLERANCE,
+            backend,
+            preconditioner,
+            maxiter,
+            mixed_precision,
+        )
+    middle = time.perf_counter()
+    Uu = factor.solve(B)
+    end = time.perf_counter()
+    if full_output:  # Before clipping, to measure only the solve
+        normB = np.linalg.norm(B, axis=0)
+        normR = np.linalg.norm(B - Kuu @ Uu, axis=0)
+        relative = normR / np.where(normB == 0, 1, normB)
+    clipped = np.abs(Uu) < TOLERANCE
+    Uu[clipped] = 0
+    Uexp = np.zeros(Fexp.shape, dtype="float64")
+    Uexp[known] = Uk[:, None]
+    Uexp[unknown] = Uu
+    Fexp[known] += (Kkk @ Uk)[:, None] + Kku @ Uu
+    F = Fexp.reshape(np.shape(F))
+    U = Uexp.reshape(np.shape(F))
+    if not full_output:
+        return U, F
+    report = SolveReport()
+    report.backend = factor.backend
+    report.size = len(unknown)
+    report.nnz = Kuu.nnz if sparse.issparse(Kuu) else np.count_nonzero(Kuu)
+    report.ncases = B.shape[1]
+    report.factorization_time = middle - start
+    report.solve_time = end - middle
+    report.iterations = factor.iterations
+    report.mixed_precision = factor.mixed_precision
+    report.leastsquare = factor.leastsquare
+    report.nclipped = int(np.sum(clipped))
+    report.lowrank = factor.lowrank
+    report.residual = float(np.max(relative)) if len(relative) else 0.0
+    report.condition = factor.condition() if condition else None
+    return U, F, report
+
+
+def solve_batch(
+    K: Union[np.ndarray, Tuple[sparse.spmatrix]],
+    F: np.ndarray,
+    U: np.ndarray,
+    TOLERANCE=1e-9,
+    partition: Optional[Partition] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Solves many variants of the same model, which share the boundary
+    conditions but have different stiffness matrices.
+    K is the stack of matrices, of shape (nvariants, 6*npts, 6*npts) or
+    (nvariants, npts, 6, npts, 6), or a sequence of sparse matrices.
+    F is shared, of shape (npts, 6), or one for each variant with shape
+    (nvariants, npts, 6). U is shared, like in ``solve``.
+    The small systems are solved together by the stacked LAPACK solver
+    of numpy, while the large sparse ones are joined in one block
+    diagonal matrix, decomposed only once.
+    Returns U and F of shape (nvariants, npts, 6)
+    """
+    if partition is None:
+        partition = Partition.from_values(U)
+    known, unknown = partition.known, partition.unknown
+    ntotal = len(known) + len(unknown)
+    if sparse.issparse(K[0]):
+        K = [sparse.csr_matrix(Ki) for Ki in K]
+        nvariants = len(K)
+        sizes = set(np.prod(Ki.shape) for Ki in K)
+    else:
+        K = np.array(K, dtype="float64")
+        nvariants = K.shape[0]
+        sizes = set([K[0].size])
+    if sizes != set([ntotal**2]):
+        error_msg = f"Each K must have shape {(ntotal, ntotal)}"
+        raise ValueError(error_msg)
+    if not sparse.issparse(K[0]):
+        K = K.reshape((nvariants, ntotal, ntotal))
+    F = np.array(F, dtype="float64")
+    Fexp = np.broadcast_to(F.reshape((-1, ntotal)), (nvariants, ntotal)).copy()
+    Uk = np.array(np.reshape(U, -1)[known], dtype="float64")
+
+    if sparse.issparse(K[0]):
+        blocks = [partition.split(Ki) for Ki in K]
+        Kkk = [block[0] for block in blocks]
+        Kku = [block[1] for block in blocks]
+        B = np.array([Fexp[i, unknown] - Kku[i].T @ Uk for i in range(nvariants)])
+        Kuu = [block[2] for block in blocks]
+        if len(unknown) == 0:
+            Uu = np.zeros((nvariants, 0), dtype="float64")
+        elif choose_backend(Kuu[0]) == "dense":
+            Kuu = np.array([Kuui.toarray() for Kuui in Kuu])
+            Uu = _solve_stacked(Kuu, B, TOLERANCE)
+        else:
+            factor = Factorization(sparse.block_diag(Kuu, "csr"), TOLERANCE)
+            Uu = factor.solve(B.reshape((-1, 1))).reshape(B.shape)
+        Fk = [Kkk[i] @ Uk + Kku[i] @ Uu[i] for i in range(nvariants)]
+    else:
+        Kknown = K[:, known]
+        Kkk, Kku = Kknown[:, :, known], Kknown[:, :, unknown]
+        Kuu = K[:, unknown][:, :, unknown]
+        B = Fexp[:, unknown] - np.einsum("vku,k->vu", Kku, Uk)
+        Uu = _solve_stacked(Kuu, B, TOLERANCE)
+        Fk = Kkk @ Uk + np.einsum("vku,vu->vk", Kku, Uu)
     Uu[np.abs(Uu) < TOLERANCE] = 0
-    Uexp[mask] = Uu
-    Fu = Kkk @ Uk + Kku @ Uu
-    Fexp[~mask] += Fu
-    F = Fexp.reshape((npts, ndofs))
-    U = Uexp.reshape((npts, ndofs)).astype("float64")
-    return U, F
+    Uexp = np.zeros(Fexp.shape, dtype="float64")
+    Uexp[:, known] = Uk
+    Uexp[:, unknown] = Uu
+    Fexp[:, known] += np.array(Fk).reshape((nvariants, len(known)))
+    shape = (nvariants,) + np.shape(U)
+    return Uexp.reshape(shape), Fexp.reshape(shape)
+
+
+def _solve_stacked(Kuu: np.ndarray, B: np.ndarray, TOLERANCE=1e-9) -> np.ndarray:
+    """
+    Solves Kuu[i] @ X[i] = B[i] for every i with one call of numpy.
+    If one of the matrices is singular, each one is solved separately
+    """
+    if Kuu.shape[1] == 0:
+        return np.zeros(B.shape, dtype="float64")
+    try:
+        return np.linalg.solve(Kuu, B[:, :, None])[:, :, 0]
+    except la.LinAlgError:
+        factors = [Factorization(Kuui, TOLERANCE, "dense") for Kuui in Kuu]
+        return np.array([factor.solve(Bi) for factor, Bi in zip(factors, B)])
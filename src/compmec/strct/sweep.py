@@ -0,0 +1,166 @@
+"""
+Runs the same model for many combinations of parameters, like a design
+study over section sizes, materials and loads. Each combination builds
+and solves its own StaticSystem inside a pool of processes, and only
+compact arrays are sent back, instead of the systems and elements.
+"""
+
+import itertools
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from compmec.strct.system import StaticSystem
+
+
+def parameter_grid(grid: Dict[str, Iterable]) -> List[Dict]:
+    """
+    Gives all the combinations of the values of each parameter:
+        parameter_grid({"diameter": [8, 10], "load": [-10, 10]})
+        [{"diameter": 8, "load": -10}, {"diameter": 8, "load": 10},
+         {"diameter": 10, "load": -10}, {"diameter": 10, "load": 10}]
+    """
+    if not isinstance(grid, dict):
+        raise TypeError(f"The grid must be a dictionary, not {type(grid)}")
+    names = list(grid.keys())
+    values = [list(grid[name]) for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def summarize(system: StaticSystem, fields: Tuple[str] = ()) -> Dict[str, np.ndarray]:
+    """
+    Gives the compact results of a solved system:
+        "max_displacement": the biggest translation of the points
+        "supports": coordinates of each point with a boundary condition,
+                    of shape (nsupports, 3), in the order their first
+                    boundary condition was added
+        "reactions": forces and momentums on the supports, of shape
+                     (nsupports, 6). They are zero on the free degrees
+                     of freedom of these points
+        fieldname: values of the field on the knots of each element,
+                   one after the other, like "U" of shape (nknots, 3)
+    """
+    if system._solution is None:
+        raise ValueError("You must run the simulation before summarize")
+    U, F = system._solution, system._forces
+    known = np.zeros(system._partition.shape, dtype="bool")
+    known.flat[system._partition.known] = True
+    bcvals = np.array(system._boundarycondition.bcvals, dtype="float64")
+    local_indexs = system._geometry.local_indexs(bcvals.reshape((-1, 3))[:, 0])
+    firsts = np.sort(np.unique(local_indexs, return_index=True)[1])
+    supports = local_indexs[firsts]
+    ndofs = known.shape[1]
+    reactions = np.zeros((len(supports), 6), dtype="float64")
+    reactions[:, :ndofs] = np.where(known[supports], F[supports, :ndofs], 0)
+    summary = {
+        "max_displacement": float(np.max(np.linalg.norm(U[:, :3], axis=1))),
+        "supports": np.array(system._geometry.points[supports]),
+        "reactions": reactions,
+    }
+    for fieldname in fields:
+        values = []
+        for element in system._structure.elements:
+            curve = element.field(fieldname)
+            values.append(np.array(curve(element.ts), dtype="float64"))
+        summary[fieldname] = np.concatenate(values)
+    return summary
+
+
+def _run_chunk(
+    builder: Callable[..., StaticSystem],
+    chunk: List[Dict],
+    fields: Tuple[str],
+    run_kwargs: Dict,
+) -> List[Dict[str, np.ndarray]]:
+    results = []
+    for parameters in chunk:
+        system = builder(**parameters)
+        if not isinstance(system, StaticSystem):
+            error_msg = f"The builder must return a StaticSystem, not {type(system)}"
+            raise TypeError(error_msg)
+        system.run(**run_kwargs)
+        results.append(summarize(system, fields))
+    return results
+
+
+def iter_sweep(
+    builder: Callable[..., StaticSystem],
+    grid: Union[Dict[str, Iterable], Iterable[Dict]],
+    fields: Tuple[str] = (),
+    max_workers: Optional[int] = None,
+    chunksize: Optional[int] = None,
+    **run_kwargs,
+) -> Iterator[Tuple[Dict, Dict[str, np.ndarray]]]:
+    """
+    Gives the pairs (parameters, summary) in the order of the grid,
+    as soon as each group of ``chunksize`` parameters is solved.
+    See ``sweep`` for the arguments
+    """
+    if not callable(builder):
+        raise TypeError(f"The builder must be callable, not {type(builder)}")
+    if isinstance(grid, dict):
+        grid = parameter_grid(grid)
+    grid = list(grid)
+    fields = tuple(fields)
+    if max_workers == 1:
+        for parameters in grid:
+            yield parameters, _run_chunk(builder, [parameters], fields, run_kwargs)[0]
+        return
+    if chunksize is None:  # About 4 chunks for each process
+        nworkers = max_workers if max_workers else (os.cpu_count() or 1)
+        chunksize = max(1, math.ceil(len(grid) / (4 * nworkers)))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        chunks = [grid[i : i + chunksize] for i in range(0, len(grid), chunksize)]
+        nchunks = len(chunks)
+        results = executor.map(
+            _run_chunk,
+            [builder] * nchunks,
+            chunks,
+            [fields] * nchunks,
+            [run_kwargs] * nchunks,
+        )
+        for chunk, summaries in zip(chunks, results):
+            yield from zip(chunk, summaries)
+
+
+def sweep(
+    builder: Callable[..., StaticSystem],
+    grid: Union[Dict[str, Iterable], Iterable[Dict]],
+    fields: Tuple[str] = (),
+    max_workers: Optional[int] = None,
+    chunksize: Optional[int] = None,
+    **run_kwargs,
+) -> Dict[str, Union[List, np.ndarray]]:
+    """
+    Solves the system given by ``builder(**parameters)`` for each set of
+    parameters of the grid, in parallel processes:
+        def builder(diameter: float, load: float) -> StaticSystem:
+            ...
+            return system
+        grid = {"diameter": [8, 10, 12], "load": [-10, 10]}
+        results = sweep(builder, grid, fields=["U"])
+    The grid is a dictionary with the values of each parameter, or a list
+    with each set of parameters. The builder must be a function defined
+    in a module, so it can be sent to the other processes.
+    Each process solves ``chunksize`` sets of parameters at once.
+    If ``max_workers`` is 1, everything runs in this process.
+    The remaining arguments are given to ``StaticSystem.run``.
+    Returns a dictionary with the list of "parameters" and the arrays
+    of ``summarize``, with one more dimension for the sets of parameters
+    """
+    results = {"parameters": []}
+    for parameters, summary in iter_sweep(
+        builder, grid, fields, max_workers, chunksize, **run_kwargs
+    ):
+        results["parameters"].append(parameters)
+        for key, value in summary.items():
+            results.setdefault(key, []).append(value)
+    for key, values in results.items():
+        if key == "parameters":
+            continue
+        if len(set(np.shape(value) for value in values)) == 1:
+            results[key] = np.array(values)
+    return results
@@ -1,11 +1,21 @@
-from typing import Callable, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
 
-from compmec.strct.__classes__ import Element1D, System
+from compmec.strct.__classes__ import Element1D, Section, System
+from compmec.strct.element import Truss
 from compmec.strct.fields import ComputeFieldBeam
-from compmec.strct.geometry import Geometry1D, Point3D
-from compmec.strct.solver import solve
+from compmec.strct.geometry import Geometry1D, Point3D, PointRegistry
+from compmec.strct.solver import (
+    SPARSE_MINIMUM_SIZE,
+    FactorizationCache,
+    Partition,
+    SolveReport,
+    solve,
+    solve_batch,
+)
 
 
 class StaticLoad(object):
@@ -120,17 +130,68 @@ class StaticStructure(object):
 
 
 class StaticSystem(System):
-    def __new__(cls):
-        if not hasattr(cls, "instance"):
-            cls.instance = super(StaticSystem, cls).__new__(cls)
-        return cls.instance
-
     def __init__(self):
-        self._geometry = Geometry1D()
+        self.clear()
+
+    def clear(self):
+        """
+        Removes the elements, loads, boundary conditions and points,
+        to start another analysis without the data of the previous one
+        """
+        self._registry = PointRegistry()
+        self._geometry = Geometry1D(self._registry)
         self._structure = StaticStructure()
+        self._connectivity = []
+        self._nodes = []
         self._loads = StaticLoad()
         self._boundarycondition = StaticBoundaryCondition()
         self._solution = None
+        self._forces = None
+        self._partition = None
+        self._partitionkey = None
+        self._report = None
+        self._cache = FactorizationCache()
+
+    @property
+    def report(self) -> SolveReport:
+        """
+        The report of the last solve, from ``run`` or ``run_load_cases``
+        """
+        if self._report is None:
+            raise ValueError("You must run the simulation before calling 'report'")
+        return self._report
+
+    @property
+    def tolerance(self) -> float:
+        """
+        Distance below which two points are merged in the same node
+        """
+        return self._registry.tolerance
+
+    def set_tolerance(self, value: float, relative: bool = False):
+        """
+        Sets the distance below which two points are merged in the same
+        node. If ``relative`` is True, the value is a fraction of the
+        diagonal of the box which contains the elements, so the same value
+        works for models in meters or in millimeters. In that case it must
+        be called after adding the elements:
+            system.set_tolerance(1e-3)  # absolute, in units of the model
+            system.set_tolerance(1e-9, relative=True)
+        """
+        if not isinstance(value, (int, float)):
+            raise TypeError(f"The tolerance must be a float, not {type(value)}")
+        if not value > 0:
+            raise ValueError(f"The tolerance must be positive, received {value}")
+        if relative:
+            elements = self._structure.elements
+            if len(elements) == 0:
+                error_msg = "You must add the elements before a relative tolerance"
+                raise ValueError(error_msg)
+            points = [np.array(element.path.ctrlpoints) for element in elements]
+            points = np.concatenate(points).reshape((-1, 3))
+            diagonal = np.linalg.norm(np.ptp(points, axis=0))
+            value *= float(diagonal) if diagonal > 0 else 1.0
+        self._registry.tolerance = value
 
     def add_element(self, element: Element1D):
         self._structure.add_element(element)
@@ -147,7 +208,7 @@ class StaticSystem(System):
             Mn: Momentum in normal direction
         """
         StaticLoad._verify_key(key)
-        index = Point3D(point).get_index()
+        index = self._registry.get_index(Point3D(point))
         self._loads.add_conc_load_at_index(index, key, load)
 
     def _refine_vector(self, vector: Tuple[float], ndiv: int):
@@ -207,9 +268,8 @@ class StaticSystem(System):
         But we use 4 values of evaluation for each point
         """
         ts = element.ts
-        points = element.path.evaluate(ts)
-        for j, point in enumerate(points):
-            self._geometry.add_point(point)
+        points = element.nodes
+        self._geometry.add_points(points)
         forceknots = np.zeros((len(ts), 3), dtype="float64")
         momenknots = np.zeros((len(ts), 3), dtype="float64")
         ndiv = 3
@@ -248,7 +308,7 @@ class StaticSystem(System):
             forceknots[z + 1] += Fb
         for z, tz in enumerate(ts):  # Apply as concentrated load on each point
             point = Point3D(points[z])
-            index = point.get_index()
+            index = self._registry.get_index(point)
             self._loads.add_conc_load_at_index(index, "Fx", forceknots[z, 0])
             self._loads.add_conc_load_at_index(index, "Fy", forceknots[z, 1])
             self._loads.add_conc_load_at_index(index, "Fz", forceknots[z, 2])
@@ -259,69 +319,372 @@ class StaticSystem(System):
     def add_BC(self, point: Point3D, key: str, value: float):
         StaticBoundaryCondition._verify_key(key)
         StaticBoundaryCondition._verify_bc_value(value)
-        index = Point3D(point).get_index()
+        index = self._registry.get_index(Point3D(point))
         self._boundarycondition.add_BC_at_index(index, key, value)
 
-    def __getpointsfrom(self, element: Element1D):
-        for t in element.ts:
-            point = element.path(t)
-            point = Point3D(point)
-            if point not in self._geometry:
-                self._geometry.add_point(point)
+    def mount_connectivity(self) -> List[np.ndarray]:
+        """
+        Gives, for each element, the index in the geometry of each knot's
+        point. It's kept by the system, so only the points of the elements
+        added after the last call are evaluated, and they are all searched
+        by only one call of ``add_points``.
+        If the path of an element changed since its row was computed,
+        the geometry and all the rows are built again
+        """
+        elements = self._structure.elements
+        olds = [element.nodes for element in elements[: len(self._nodes)]]
+        if any(new is not old for new, old in zip(olds, self._nodes)):
+            self._geometry = Geometry1D(self._registry)
+            self._connectivity, self._nodes = [], []
+            self._partitionkey = None
+            self._cache.clear()
+        elements = elements[len(self._connectivity) :]
+        if len(elements) == 0:
+            return self._connectivity
+        nodes = [element.nodes for element in elements]
+        indexs = self._geometry.add_points(np.concatenate(nodes))
+        sizes = np.cumsum([len(points) for points in nodes])
+        self._connectivity += np.split(indexs, sizes[:-1])
+        self._nodes += nodes
+        return self._connectivity
+
+    @property
+    def ndofs(self) -> int:
+        """
+        The number of degrees of freedom of each point. It's 3 if all
+        the elements are trusses, since the rotations of the points of
+        a pin-jointed structure are not connected to anything, else 6
+        """
+        elements = self._structure.elements
+        if len(elements) and all(isinstance(elem, Truss) for elem in elements):
+            return 3
+        return 6
+
+    def __reduce(self, values: np.ndarray, description: str) -> np.ndarray:
+        """
+        Removes the rotational columns of a matrix of shape (npts, 6)
+        if the structure has only trusses, giving (npts, ndofs)
+        """
+        ndofs = self.ndofs
+        if ndofs == 6:
+            return values
+        if np.any(np.nan_to_num(values[:, ndofs:]) != 0):
+            error_msg = "The structure has only trusses, "
+            error_msg += f"so it can't have {description}"
+            raise ValueError(error_msg)
+        return values[:, :ndofs]
+
+    @staticmethod
+    def __expand(values: np.ndarray, axis: int) -> np.ndarray:
+        """
+        Fills with zeros the rotational columns of a result computed
+        with 3 degrees of freedom per point, giving 6 values on ``axis``
+        """
+        if values.shape[axis] == 6:
+            return values
+        shape = list(values.shape)
+        shape[axis] = 6
+        expanded = np.zeros(shape, dtype="float64")
+        index = (slice(None),) * axis + (slice(0, values.shape[axis]),)
+        expanded[index] = values
+        return expanded
 
     def mount_U(self) -> np.ndarray:
+        """
+        Assembles the matrix of shape (npts, ndofs) with the displacements
+        given by the boundary conditions. The unknown values are ``nan``
+        """
         npts = self._geometry.npts
-        U = np.empty((npts, 6), dtype="object")
-        for global_index, position, displacement in self._boundarycondition.bcvals:
-            local_index = self._geometry._global_indexs.index(global_index)
-            U[local_index, position] = displacement
-        return U
-
-    def mount_F(self) -> np.ndarray:
+        U = np.full((npts, 6), np.nan)
+        bcvals = np.array(self._boundarycondition.bcvals, dtype="float64")
+        bcvals = bcvals.reshape((-1, 3))
+        local_indexs = self._geometry.local_indexs(bcvals[:, 0])
+        U[local_indexs, bcvals[:, 1].astype("int64")] = bcvals[:, 2]
+        return self.__reduce(U, "imposed rotations")
+
+    def mount_partition(self) -> Partition:
+        """
+        Gives the partition of known and unknown displacements, from
+        the positions of the boundary conditions. It's built again only
+        if boundary conditions or points were added, or the points were
+        renumbered, else the kept partition is reused by the next solves
+        """
+        npts, ndofs = self._geometry.npts, self.ndofs
+        key = (len(self._boundarycondition.bcvals), npts, ndofs)
+        if key == self._partitionkey:
+            return self._partition
+        bcvals = np.array(self._boundarycondition.bcvals, dtype="float64")
+        bcvals = bcvals.reshape((-1, 3))
+        positions = bcvals[:, 1].astype("int64")
+        local_indexs = self._geometry.local_indexs(bcvals[:, 0])
+        known = np.zeros((npts, ndofs), dtype="bool")
+        valid = positions < ndofs
+        known[local_indexs[valid], positions[valid]] = True
+        self._partition = Partition(known)
+        self._partitionkey = key
+        return self._partition
+
+    def mount_F(self, loads: Optional[StaticLoad] = None) -> np.ndarray:
+        """
+        Assembles the force matrix of shape (npts, ndofs) from the loads
+        of the system. Another group of loads can be given, like a load case
+        """
+        if loads is None:
+            loads = self._loads
         npts = self._geometry.npts
         F = np.zeros((npts, 6))
-        for global_index, position, loads in self._loads.loads:
-            local_index = self._geometry._global_indexs.index(global_index)
-            F[local_index, position] += loads
-        return F
+        loads = np.array(loads.loads, dtype="float64").reshape((-1, 3))
+        local_indexs = self._geometry.local_indexs(loads[:, 0])
+        np.add.at(F, (local_indexs, loads[:, 1].astype("int64")), loads[:, 2])
+        return self.__reduce(F, "applied momentums")
 
-    def mount_K(self) -> np.ndarray:
+    def mount_K(self) -> sparse.csr_matrix:
+        """
+        Assembles the global stiffness matrix in sparse form.
+        Each element gives the [12 x 12] matrices of all its segments
+        at once, which are scattered as (row, column, value) triplets.
+        Repeated entries are summed when converting to CSR,
+        with shape (ndofs*npts, ndofs*npts)
+        """
+        npts, ndofs = self._geometry.npts, self.ndofs
+        rows, cols, vals = [], [], []
+        connectivity = self.mount_connectivity()
+        for element, nodes in zip(self._structure.elements, connectivity):
+            Ksegs = element.segment_stiffness_matrices()[:, :, :ndofs, :, :ndofs]
+            Ksegs = Ksegs.reshape((len(Ksegs), 2 * ndofs, 2 * ndofs))
+            dofs = self.__segment_dofs(nodes, ndofs)
+            nonzero = np.nonzero(Ksegs)
+            rows.append(dofs[nonzero[0], nonzero[1]])
+            cols.append(dofs[nonzero[0], nonzero[2]])
+            vals.append(Ksegs[nonzero])
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        vals = np.concatenate(vals)
+        shape = (ndofs * npts, ndofs * npts)
+        K = sparse.coo_matrix((vals, (rows, cols)), shape=shape)
+        return K.tocsr()
+
+    @staticmethod
+    def __segment_dofs(nodes: np.ndarray, ndofs: int) -> np.ndarray:
+        """
+        Gives the 2*ndofs global dofs of each segment of an element,
+        from its nodes. Returns an array of shape (nsegments, 2*ndofs)
+        """
+        pairs = np.stack([nodes[:-1], nodes[1:]], axis=1)
+        dofs = ndofs * pairs[:, :, None] + np.arange(ndofs)
+        return dofs.reshape((len(pairs), 2 * ndofs))
+
+    def __verify_variant(self, variant: Dict[Element1D, Section]):
+        if not isinstance(variant, dict):
+            raise TypeError(f"Each variant must be a dict, not {type(variant)}")
+        for element in variant:
+            if element not in self._structure.elements:
+                error_msg = f"The element {element} is not in the system"
+                raise ValueError(error_msg)
+
+    def mount_K_variants(
+        self, variants: Iterable[Dict[Element1D, Section]]
+    ) -> Union[np.ndarray, List[sparse.csr_matrix]]:
+        """
+        Assembles the stiffness matrix of many variants of the structure.
+        Each variant is a dictionary with the new section of some elements,
+        the other elements keep their section:
+            variants = [{beam: (steel, Circle(8))},
+                        {beam: (steel, Circle(10)), truss: (alu, Square(4))}]
+        The matrices share the same sparsity pattern, so only the values
+        of the changed elements are computed again for each variant.
+        The elements are not changed, so they can be shared by other
+        systems running at the same time.
+        Returns a stack of shape (nvariants, ndofs*npts, ndofs*npts) if the
+        system is small, or a list of sparse matrices
+        """
+        variants = list(variants)
+        for variant in variants:
+            self.__verify_variant(variant)
+        npts, ndofs = self._geometry.npts, self.ndofs
+        nvariants = len(variants)
+        rows, cols, vals = [], [], []
+        connectivity = self.mount_connectivity()
+        for element, nodes in zip(self._structure.elements, connectivity):
+            dofs = self.__segment_dofs(nodes, ndofs)
+            Ksegs = element.segment_stiffness_matrices()[:, :, :ndofs, :, :ndofs]
+            Kvar = np.tile(Ksegs, (nvariants, 1, 1, 1, 1, 1))
+            for i, variant in enumerate(variants):
+                if element in variant:
+                    Ksegs = element.segment_stiffness_matrices(variant[element])
+                    Kvar[i] = Ksegs[:, :, :ndofs, :, :ndofs]
+            rows.append(np.repeat(dofs, 2 * ndofs, axis=1).flatten())
+            cols.append(np.tile(dofs, 2 * ndofs).flatten())
+            vals.append(Kvar.reshape((nvariants, -1)))
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        vals = np.concatenate(vals, axis=1)
+        shape = (ndofs * npts, ndofs * npts)
+        if shape[0] < SPARSE_MINIMUM_SIZE:
+            K = np.zeros((nvariants,) + shape, dtype="float64")
+            np.add.at(K, (slice(None), rows, cols), vals)
+            return K
+        return [
+            sparse.csr_matrix((values, (rows, cols)), shape=shape) for values in vals
+        ]
+
+    def renumber_points(self):
+        """
+        Reorders the points of the geometry with the reverse Cuthill-McKee
+        algorithm, which reduces the bandwidth of the stiffness matrix.
+        Since every index is found by position, the results are the same
+        """
+        connectivity = self.mount_connectivity()
         npts = self._geometry.npts
-        K = np.zeros((npts, 6, npts, 6))
-        for element in self._structure.elements:
-            Kloc = element.stiffness_matrix()
-            local_indexs = []
-            for t in element.ts:
-                searchpoint = element.path(t)
-                local_index = self._geometry.find_point(searchpoint)
-                local_indexs.append(local_index)
-            for i, indi in enumerate(local_indexs):
-                for j, indj in enumerate(local_indexs):
-                    K[indi, :, indj, :] += Kloc[i, :, j, :]
-        return K
-
-    def run(self):
+        rows = np.concatenate([nodes[:-1] for nodes in connectivity])
+        cols = np.concatenate([nodes[1:] for nodes in connectivity])
+        graph = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), (npts, npts))
+        graph = sparse.csr_matrix(graph + graph.T)
+        permutation = csgraph.reverse_cuthill_mckee(graph, symmetric_mode=True)
+        self._geometry.renumber(permutation)
+        inverse = np.argsort(permutation)
+        self._connectivity = [inverse[nodes] for nodes in connectivity]
+        self._partitionkey = None
+
+    def __prepare(self, renumber: bool):
         if len(self._structure.elements) == 0:
             error_msg = "You must have at least one element to run the simulation"
             raise ValueError(error_msg)
-        for element in self._structure.elements:
-            self.__getpointsfrom(element)
+        self.mount_connectivity()
+        if renumber:
+            self.renumber_points()
+
+    def run(self, renumber: bool = False, condition: bool = False, **kwargs):
+        """
+        Solves the system and computes the fields of each element.
+        If ``renumber`` is True, the points are reordered to reduce
+        the bandwidth before assembling the matrix.
+        If ``condition`` is True, the report also has the estimate of the
+        condition number, which costs a few more solves.
+        The remaining arguments are given to ``solve``, like ``backend``.
+        The decomposition of the matrix is kept between runs: if only
+        supports are added or few elements are changed, the next run
+        corrects the kept decomposition instead of making a new one.
+        If all the elements are trusses, only the 3 displacements of
+        each point are solved and the rotations are zero
+        """
+        self.__prepare(renumber)
         K = self.mount_K()
         F = self.mount_F()
         U = self.mount_U()
-        U, F = solve(K, F, U)
-        self._solution = U
+        partition = self.mount_partition()
+        U, F, self._report = solve(
+            K,
+            F,
+            U,
+            partition=partition,
+            full_output=True,
+            cache=self._cache,
+            condition=condition,
+            **kwargs,
+        )
+        self._solution = self.__expand(U, 1)
+        self._forces = self.__expand(F, 1)
         self.apply_on_elements()
 
+    def run_variants(
+        self, variants: Iterable[Dict[Element1D, Section]], renumber: bool = False
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Solves many variants of the structure, which differ only by the
+        section of some elements, like in a parametric study.
+        See ``mount_K_variants`` for the format of ``variants``.
+        All the variants are solved together by ``solve_batch``.
+        Returns U and F of shape (nvariants, npts, 6).
+        The elements' field, from ``run``, are not changed.
+        Use ``compute_fields(U[i], variants[i])`` to get the fields
+        of the variant ``i``
+        """
+        self.__prepare(renumber)
+        K = self.mount_K_variants(variants)
+        F = self.mount_F()
+        U = self.mount_U()
+        partition = self.mount_partition()
+        U, F = solve_batch(K, F, U, partition=partition)
+        return self.__expand(U, 2), self.__expand(F, 2)
+
+    def run_load_cases(
+        self,
+        cases: Dict[str, Iterable[Tuple[Point3D, str, float]]],
+        renumber: bool = False,
+        condition: bool = False,
+        **kwargs,
+    ) -> Dict[str, Dict]:
+        """
+        Solves many load cases with only one factorization of the matrix.
+        Each case is a group of concentrated loads (point, key, value):
+            cases = {"wind": [((0, 0, 1000), "Fx", 20)],
+                     "snow": [((0, 0, 1000), "Fz", -50),
+                              ((0, 500, 1000), "Fz", -50)]}
+        The loads added to the system before are applied on every case.
+        Returns a dictionary which for each case has
+            "U": displacements of the points, shape (npts, 6)
+            "F": forces and reactions of the points, shape (npts, 6)
+            "fields": the field of each element, in the order of the elements
+        The elements' field, from ``run``, are not changed.
+        See ``run`` for ``condition`` and the remaining arguments.
+        """
+        if not isinstance(cases, dict):
+            raise TypeError(f"Cases must be a dictionary, not {type(cases)}")
+        if len(cases) == 0:
+            raise ValueError("You must give at least one load case")
+        caseloads = []
+        for name, loads in cases.items():
+            caseloads.append(StaticLoad())
+            for point, key, value in loads:
+                StaticLoad._verify_key(key)
+                index = self._registry.get_index(Point3D(point))
+                caseloads[-1].add_conc_load_at_index(index, key, value)
+        self.__prepare(renumber)
+        K = self.mount_K()
+        U = self.mount_U()
+        Fbase = self.mount_F()
+        F = [Fbase + self.mount_F(loads) for loads in caseloads]
+        F = np.stack(F, axis=2)
+        partition = self.mount_partition()
+        U, F, self._report = solve(
+            K,
+            F,
+            U,
+            partition=partition,
+            full_output=True,
+            cache=self._cache,
+            condition=condition,
+            **kwargs,
+        )
+        U, F = self.__expand(U, 1), self.__expand(F, 1)
+        results = {}
+        for i, name in enumerate(cases):
+            fields = self.compute_fields(U[:, :, i])
+            results[name] = {"U": U[:, :, i], "F": F[:, :, i], "fields": fields}
+        return results
+
+    def compute_fields(
+        self,
+        solution: np.ndarray,
+        variant: Optional[Dict[Element1D, Section]] = None,
+    ) -> List[ComputeFieldBeam]:
+        """
+        Computes the field of each element from the solution of shape (npts, 6).
+        If the solution is of a variant, from ``run_variants``, the same
+        variant must be given, so the forces use the sections of the variant
+        """
+        if variant is None:
+            variant = {}
+        self.__verify_variant(variant)
+        fields = []
+        connectivity = self.mount_connectivity()
+        for element, nodes in zip(self._structure.elements, connectivity):
+            section = variant.get(element)
+            fields.append(ComputeFieldBeam(element, solution[nodes], section))
+        return fields
+
     def apply_on_elements(self):
-        for element in self._structure.elements:
-            npts = len(element.ts)
-            points = element.path(element.ts)
-            indexs = np.zeros(npts, dtype="int32")
-            for i, p in enumerate(points):
-                indexs[i] = self._geometry.find_point(p)
-            Uelem = np.zeros((npts, 6))
-            for i, j in enumerate(indexs):
-                Uelem[i, :] = self._solution[j, :]
-            field = ComputeFieldBeam(element, Uelem)
+        fields = self.compute_fields(self._solution)
+        for element, field in zip(self._structure.elements, fields):
             element.set_field(field)
@@ -1,7 +1,14 @@
 import numpy as np
 import pytest
 
-from compmec.strct.geometry import Geometry1D, Point2D, Point3D
+from compmec.strct.geometry import (
+    Geometry1D,
+    Point2D,
+    Point3D,
+    PointArray,
+    PointRegistry,
+    SpatialHash,
+)
 
 
 @pytest.mark.order(2)
@@ -155,6 +162,103 @@ class TestPoint3D:
         with pytest.raises(ValueError):
             C.get_index()
 
+    @pytest.mark.order(2)
+    @pytest.mark.timeout(1)
+    @pytest.mark.dependency(depends=["TestPoint3D::test_begin"])
+    def test_spatial_hash(self):
+        spatial = SpatialHash(0.5)
+        assert spatial.insert((0, 0, 0)) == 0
+        assert spatial.insert((0.4, 0.1, 0)) == 1
+        assert spatial.insert((-0.1, 0, 0)) == 2
+        assert spatial.insert((3, 3, 3)) == 3
+        assert len(spatial) == 4
+        assert spatial.query((0, 0, 0), 1e-3) == [0]
+        assert spatial.query((0, 0, 0), 0.15) == [0, 2]
+        assert spatial.query((0, 0, 0), 0.5) == [0, 1, 2]
+        assert spatial.query((0, 0, 0), 10) == [0, 1, 2, 3]
+        assert spatial.query((1, 1, 1), 0.3) == []
+        queries = [(0, 0, 0), (1, 1, 1), (3, 3, 3.1), (0.3, 0, 0)]
+        positions, indexs = spatial.query_many(queries, 0.15)
+        pairs = sorted(zip(positions.tolist(), indexs.tolist()))
+        assert pairs == [(0, 0), (0, 2), (2, 3), (3, 1)]
+        for radius in (1e-3, 0.5, 1):
+            positions, indexs = spatial.query_many(queries, radius)
+            for i, query in enumerate(queries):
+                assert sorted(indexs[positions == i]) == spatial.query(query, radius)
+        # Far cells with the same key are not confused
+        far = (0.5 * 2**SpatialHash.BITS, 0, 0)
+        assert SpatialHash.key(spatial.cell(far)) == SpatialHash.key((0, 0, 0))
+        assert spatial.query(far, 0.15) == []
+        assert len(spatial.query_many([far], 0.15)[0]) == 0
+        spatial.clear()
+        assert len(spatial) == 0
+        assert spatial.query((0, 0, 0), 0.5) == []
+        with pytest.raises(TypeError):
+            SpatialHash("asd")
+        with pytest.raises(ValueError):
+            SpatialHash(0)
+
+    @pytest.mark.order(2)
+    @pytest.mark.timeout(1)
+    @pytest.mark.dependency(
+        depends=["TestPoint3D::test_begin", "TestPoint3D::test_spatial_hash"]
+    )
+    def test_registry(self):
+        registry = PointRegistry()
+        assert len(registry) == 0
+        assert registry.find((1, 2, 3)) is None
+        assert registry.get_index((1, 2, 3)) == 0
+        assert registry.get_index((4, 5, 6)) == 1
+        assert registry.get_index((1, 2, 3 + 1e-5)) == 0
+        assert registry.find((4, 5, 6)) == 1
+        assert registry[1] == (4, 5, 6)
+        assert len(registry) == 2
+        point = Point3D([4, 5, 6])
+        assert registry.add(point) == 2
+        assert registry.find(point) == 2
+        with pytest.raises(ValueError):
+            registry.find([4, 5, 6])
+        registry.clear()
+        assert len(registry) == 0
+        assert registry.find((1, 2, 3)) is None
+
+        registry = PointRegistry(tolerance=0.1)
+        assert registry.tolerance == 0.1
+        assert registry.get_index((0, 0, 0)) == 0
+        assert registry.get_index((0, 0, 0.05)) == 0
+        assert registry.get_index((0, 0, 0.2)) == 1
+        registry.tolerance = 0.01
+        assert registry.find((0, 0, 0.2)) == 1
+        assert registry.get_index((0, 0, 0.05)) == 2
+        registry.tolerance = 1
+        with pytest.raises(ValueError):
+            registry.find((0, 0, 0.1))
+        with pytest.raises(TypeError):
+            PointRegistry(tolerance="asd")
+        with pytest.raises(ValueError):
+            PointRegistry(tolerance=0)
+
+        other = PointRegistry()
+        A = Point3D((7, 8, 9))
+        assert other.get_index(A) == 0
+        assert A.femid is None or Point3D.registry[A.femid] == A
+        Point3D.registry.clear()
+        assert A.femid is None
+        assert A.get_index() == 0
+
+    @pytest.mark.order(2)
+    @pytest.mark.timeout(4)
+    @pytest.mark.dependency(
+        depends=["TestPoint3D::test_begin", "TestPoint3D::test_registry"]
+    )
+    def test_many_points(self):
+        coords = 1000 + 0.01 * np.random.permutation(20000)
+        points = [Point3D((x, 2 * x, -x)) for x in coords]
+        indexs = [point.get_index() for point in points]
+        assert len(set(indexs)) == len(points)
+        for x, index in zip(coords[::100], indexs[::100]):
+            assert Point3D((x, 2 * x, -x + 1e-5)).get_index() == index
+
     @pytest.mark.order(2)
     @pytest.mark.timeout(1)
     @pytest.mark.dependency(
@@ -184,6 +288,8 @@ class TestPoint3D:
         depends=[
             "TestPoint3D::test_begin",
             "TestPoint3D::test_add_sub",
+            "TestPoint3D::test_registry",
+            "TestPoint3D::test_many_points",
             "TestPoint3D::test_fail",
         ]
     )
@@ -191,6 +297,65 @@ class TestPoint3D:
         pass
 
 
+class TestPointArray:
+    @pytest.mark.order(2)
+    @pytest.mark.dependency(depends=["test_begin", "TestPoint3D::test_end"])
+    def test_begin(self):
+        pass
+
+    @pytest.mark.order(2)
+    @pytest.mark.timeout(1)
+    @pytest.mark.dependency(depends=["TestPointArray::test_begin"])
+    def test_creation(self):
+        points = PointArray([(0, 0, 0), (1, 2, 3), (4, 5, 6.5)])
+        assert len(points) == 3
+        assert points.coords.shape == (3, 3)
+        assert PointArray(points).coords is points.coords
+        assert len(PointArray([])) == 0
+        assert points[1] == Point3D([1, 2, 3])
+        assert isinstance(points[1], Point3D)
+        assert isinstance(points[1:], PointArray)
+        assert list(points) == [(0, 0, 0), (1, 2, 3), (4, 5, 6.5)]
+        np.testing.assert_equal(np.array(points), points.coords)
+        with pytest.raises(ValueError):
+            points.coords[0, 0] = 1
+        with pytest.raises(TypeError):
+            PointArray([("a", 0, 0)])
+        with pytest.raises(TypeError):
+            PointArray([("0", "0", "0"), (1, 0, 0)])
+        with pytest.raises(TypeError):
+            PointArray([(0, 0, None), (1, 0, 0)])
+        with pytest.raises(TypeError):
+            PointArray([(True, False, True)])
+        with pytest.raises(TypeError):
+            PointArray([[[0, 0, 0]], [[0, 0, 1]]])
+        with pytest.raises(ValueError):
+            PointArray([(0, 0), (1, 0)])
+
+    @pytest.mark.order(2)
+    @pytest.mark.timeout(1)
+    @pytest.mark.dependency(depends=["TestPointArray::test_creation"])
+    def test_operations(self):
+        points = PointArray([(0, 0, 0), (1, 2, 3), (4, 5, 6.5)])
+        good = [(1, 1, 1), (2, 3, 4), (5, 6, 7.5)]
+        assert np.all(points + (1, 1, 1) == good)
+        assert np.all((1, 1, 1) + points == good)
+        assert np.all(PointArray(good) - points == (1, 1, 1))
+        assert np.all(np.ones(3) - points == [(1, 1, 1), (0, -1, -2), (-3, -4, -5.5)])
+        assert np.all(points + points == 2 * points.coords)
+        np.testing.assert_equal(points == (1, 2, 3), [False, True, False])
+        np.testing.assert_equal(points != (1, 2, 3), [True, False, True])
+        np.testing.assert_equal(points == "asd", [False, False, False])
+        np.testing.assert_almost_equal(points.norm(), np.linalg.norm(points, axis=1))
+
+    @pytest.mark.order(2)
+    @pytest.mark.dependency(
+        depends=["TestPointArray::test_creation", "TestPointArray::test_operations"]
+    )
+    def test_end(self):
+        pass
+
+
 class TestGeometry:
     @pytest.mark.order(2)
     @pytest.mark.dependency(depends=["test_begin", "TestPoint3D::test_end"])
@@ -223,10 +388,99 @@ class TestGeometry:
         assert geometry.find_point([0, 0, 0], tolerance=6) == 0
         assert geometry.find_point([0, 0, 0], tolerance=5.5) == 0
         assert geometry.find_point([0, 0, 0], tolerance=5) is None
+        assert geometry.find_point([2, 3, 4 + 1e-4]) == 0
+        assert geometry.find_point([2, 3, 4 + 1e-2]) is None
+        geometry.registry.tolerance = 0.1
+        assert geometry.find_point([2, 3, 4 + 1e-2]) == 0
         assert geometry.npts == 2
         all_points = ((2, 3, 4), (-2, 3.0, 5))
         np.testing.assert_almost_equal(geometry.points, all_points)
 
+    @pytest.mark.order(2)
+    @pytest.mark.timeout(2)
+    @pytest.mark.dependency(depends=["TestGeometry::test_find_point"])
+    def test_points_buffer(self):
+        geometry = Geometry1D()
+        coords = np.random.uniform(-1, 1, (100, 3))
+        for i, point in enumerate(coords):
+            assert geometry.add_point(point) == i
+        assert geometry.add_point(coords[30]) == 30
+        assert geometry.npts == 100
+        points = geometry.points
+        assert points.shape == (100, 3)
+        np.testing.assert_equal(points, coords)
+        with pytest.raises(ValueError):
+            points[0, 0] = 10
+        for i in (0, 17, 99):
+            assert geometry.find_point(coords[i]) == i
+
+        permutation = np.random.permutation(100)
+        geometry.renumber(permutation)
+        np.testing.assert_equal(geometry.points, coords[permutation])
+        for i in (0, 17, 99):
+            assert geometry.find_point(coords[permutation[i]]) == i
+
+    @pytest.mark.order(2)
+    @pytest.mark.timeout(4)
+    @pytest.mark.dependency(depends=["TestGeometry::test_points_buffer"])
+    def test_add_points(self):
+        geometry = Geometry1D()
+        assert geometry.add_point([1, 1, 1]) == 0
+        points = [[0, 0, 0], [1, 0, 0], [0, 0, 1e-5], [1, 1, 1 + 1e-5], [1, 0, 0]]
+        indexs = geometry.add_points(points)
+        np.testing.assert_equal(indexs, [1, 2, 1, 0, 2])
+        assert geometry.npts == 3
+        np.testing.assert_equal(geometry.points, [[1, 1, 1], [0, 0, 0], [1, 0, 0]])
+        assert geometry.add_point([1, 0, 1e-5]) == 2
+        assert len(geometry.add_points(np.zeros((0, 3)))) == 0
+
+        geometry = Geometry1D()
+        coords = np.random.uniform(-100, 100, (20000, 3))
+        points = np.concatenate([coords, coords + 1e-5 * np.random.rand(20000, 3)])
+        indexs = geometry.add_points(points)
+        np.testing.assert_equal(indexs[:20000], np.arange(20000))
+        np.testing.assert_equal(indexs[20000:], np.arange(20000))
+        np.testing.assert_equal(geometry.points, coords)
+        for i in (0, 123, 19999):
+            assert geometry.find_point(coords[i]) == i
+
+        with pytest.raises(TypeError):
+            geometry.add_points([["a", 0, 0]])
+        with pytest.raises(ValueError):
+            geometry.add_points([0, 0, 0])
+        with pytest.raises(ValueError):
+            geometry.add_points([[0, 0, np.nan]])
+
+    @pytest.mark.order(2)
+    @pytest.mark.timeout(2)
+    @pytest.mark.dependency(depends=["TestGeometry::test_add_point"])
+    def test_shared_registry(self):
+        registry = PointRegistry()
+        assert registry.get_index([5, 5, 5]) == 0
+        geometry = Geometry1D(registry)
+        assert geometry.registry is registry
+        assert geometry.add_point([2, 3, 4]) == 0
+        assert geometry.add_point([5, 5, 5]) == 1
+        assert geometry._global_indexs == [1, 0]
+        assert len(registry) == 2
+        assert Geometry1D().registry is not registry
+        np.testing.assert_equal(geometry.local_indexs([0, 1, 1]), [1, 0, 0])
+        registry.get_index([7, 7, 7])
+        with pytest.raises(ValueError):
+            geometry.local_indexs([2])
+        with pytest.raises(ValueError):
+            geometry.local_indexs([-1])
+        geometry.add_points([[7, 7, 7], [8, 8, 8]])
+        np.testing.assert_equal(geometry.local_indexs([3, 2]), [3, 2])
+        geometry.renumber([3, 2, 1, 0])
+        np.testing.assert_equal(geometry.local_indexs([0, 1, 2, 3]), [2, 3, 1, 0])
+        assert geometry.add_point([5, 5, 5]) == 2
+        geometry.clear()
+        assert geometry.npts == 0
+        assert len(registry) == 4
+        with pytest.raises(TypeError):
+            Geometry1D("asd")
+
     @pytest.mark.order(2)
     @pytest.mark.timeout(2)
     @pytest.mark.dependency(
@@ -247,7 +501,13 @@ class TestGeometry:
 
     @pytest.mark.order(2)
     @pytest.mark.dependency(
-        depends=["TestGeometry::test_find_point", "TestGeometry::test_fail"]
+        depends=[
+            "TestGeometry::test_find_point",
+            "TestGeometry::test_points_buffer",
+            "TestGeometry::test_add_points",
+            "TestGeometry::test_shared_registry",
+            "TestGeometry::test_fail",
+        ]
     )
     def test_end(self):
         pass
@@ -260,6 +520,7 @@ class TestGeometry:
         "test_begin",
         "TestPoint2D::test_end",
         "TestPoint3D::test_end",
+        "TestPointArray::test_end",
         "TestGeometry::test_end",
     ]
 )
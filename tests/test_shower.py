@@ -3,9 +3,10 @@ import pytest
 from matplotlib import pyplot as plt
 
 from compmec.strct.element import EulerBernoulli
+from compmec.strct.geometry import PointArray
 from compmec.strct.material import Isotropic
 from compmec.strct.profile import Circle
-from compmec.strct.shower import ShowerStaticSystem
+from compmec.strct.shower import Projector, ShowerStaticSystem
 from compmec.strct.system import StaticSystem
 
 
@@ -192,6 +193,18 @@ def test_all_axonometric():
             pass
 
 
+@pytest.mark.order(9)
+@pytest.mark.dependency(depends=["test_begin"])
+def test_project_array():
+    points = np.random.uniform(-1, 1, (10, 3))
+    for name in ["xy", "xz", "yz"]:
+        projector = Projector(name)
+        projected = projector(PointArray(points))
+        assert projected.shape == (10, 2)
+        for point, good in zip(points, projected):
+            np.testing.assert_almost_equal(projector(tuple(point)), good)
+
+
 @pytest.mark.order(9)
 @pytest.mark.dependency(depends=["test_fields"])
 def test_all_perspective():
@@ -257,6 +270,7 @@ def test_fails():
         "test_main1",
         "test_fields",
         "test_all_axonometric",
+        "test_project_array",
         "test_all_perspective",
         "test_fails",
     ]
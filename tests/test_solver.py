@@ -1,7 +1,17 @@
 import numpy as np
 import pytest
+from scipy import sparse
 
-from compmec.strct.solver import solve
+from compmec.strct.solver import (
+    Factorization,
+    FactorizationCache,
+    Partition,
+    bandwidth,
+    choose_backend,
+    solve,
+    solve_batch,
+    solve_cg,
+)
 
 
 @pytest.mark.order(1)
@@ -116,9 +126,378 @@ def test_random_notsingular_matrix():
         np.testing.assert_almost_equal(Ftest, Fgood)
 
 
+def random_banded_system(npts: int, ndofs: int):
+    """
+    Creates a sparse symmetric positive definite matrix K, like a chain
+    of nodes where each node is only connected to its neighbours
+    """
+    nunk = npts * ndofs
+    bandwidth = 2 * ndofs
+    diagonals = [np.random.uniform(-1, 1, nunk - k) for k in range(1, bandwidth)]
+    offsets = list(range(1, bandwidth))
+    K = sparse.diags(diagonals, offsets, shape=(nunk, nunk))
+    K = K + K.T + 4 * bandwidth * sparse.identity(nunk)
+    return sparse.csr_matrix(K)
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin", "test_random_notsingular_matrix"])
+def test_sparse_backend():
+    npts, ndofs = 200, 6
+    permutation = np.random.permutation(npts * ndofs)
+    K = random_banded_system(npts, ndofs)[permutation][:, permutation]
+    assert choose_backend(K) == "sparse"
+    assert choose_backend(K.toarray()) == "dense"
+    assert choose_backend(K[:60, :60]) == "dense"
+
+    Ugood = np.random.uniform(-1, 1, (npts, ndofs))
+    Fgood = (K @ Ugood.flatten()).reshape((npts, ndofs))
+    Uorig = np.empty((npts, ndofs), dtype="object")
+    Uorig[0, :] = Ugood[0, :]
+    Forig = np.copy(Fgood)
+    Forig[0, :] = 0
+    Usparse, Fsparse = solve(K, Forig, np.copy(Uorig))
+    np.testing.assert_almost_equal(Usparse, Ugood)
+    np.testing.assert_almost_equal(Fsparse, Fgood)
+    Udense, Fdense = solve(K, Forig, np.copy(Uorig), backend="dense")
+    np.testing.assert_almost_equal(Udense, Usparse)
+    np.testing.assert_almost_equal(Fdense, Fsparse)
+    with pytest.raises(ValueError):
+        solve(K, Forig, Uorig, backend="asd")
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin", "test_sparse_backend"])
+def test_banded_backend():
+    npts, ndofs = 200, 6
+    K = random_banded_system(npts, ndofs)
+    assert bandwidth(K) == 2 * ndofs - 1
+    assert bandwidth(K.toarray()) == 2 * ndofs - 1
+    assert choose_backend(K) == "banded"
+
+    Ugood = np.random.uniform(-1, 1, (npts, ndofs))
+    Fgood = (K @ Ugood.flatten()).reshape((npts, ndofs))
+    Uorig = np.empty((npts, ndofs), dtype="object")
+    Uorig[-1, :] = Ugood[-1, :]
+    Forig = np.copy(Fgood)
+    Forig[-1, :] = 0
+    Utest, Ftest = solve(K, Forig, np.copy(Uorig), backend="banded")
+    np.testing.assert_almost_equal(Utest, Ugood)
+    np.testing.assert_almost_equal(Ftest, Fgood)
+
+    K = sparse.csr_matrix(K + sparse.triu(K, 1))  # Not symmetric
+    Fgood = (K @ Ugood.flatten()).reshape((npts, ndofs))
+    Uorig = np.empty((npts, ndofs), dtype="object")
+    Utest, Ftest = solve(K, Fgood, Uorig, backend="banded")
+    np.testing.assert_almost_equal(Utest, Ugood)
+    np.testing.assert_almost_equal(Ftest, Fgood)
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin", "test_sparse_backend"])
+def test_cg_backend():
+    npts, ndofs = 200, 6
+    K = random_banded_system(npts, ndofs)
+    Ugood = np.random.uniform(-1, 1, (npts, ndofs))
+    Fgood = (K @ Ugood.flatten()).reshape((npts, ndofs))
+    Uorig = np.empty((npts, ndofs), dtype="object")
+    Uorig[0, :3] = Ugood[0, :3]
+    Forig = np.copy(Fgood)
+    Forig[0, :3] = 0
+    for preconditioner in ["jacobi", "block-jacobi", "ilu"]:
+        Utest, Ftest, report = solve(
+            K,
+            Forig,
+            np.copy(Uorig),
+            backend="cg",
+            preconditioner=preconditioner,
+            full_output=True,
+        )
+        np.testing.assert_almost_equal(Utest, Ugood)
+        np.testing.assert_almost_equal(Ftest, Fgood)
+        assert report.backend == "cg"
+        assert 0 < report.iterations < npts * ndofs
+        assert report.condition is None
+
+    B = np.random.uniform(-1, 1, npts * ndofs)
+    with pytest.warns(UserWarning):
+        _, niter = solve_cg(K, B, preconditioner="jacobi", maxiter=2)
+    assert niter == 2
+    X, niter = solve_cg(K, np.zeros(npts * ndofs))
+    assert niter == 0
+    np.testing.assert_almost_equal(X, 0)
+    with pytest.raises(ValueError):
+        solve_cg(K, B, preconditioner="asd")
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(
+    depends=[
+        "test_begin",
+        "test_sparse_backend",
+        "test_banded_backend",
+        "test_cg_backend",
+    ]
+)
+def test_many_load_cases():
+    npts, ndofs, ncases = 200, 6, 4
+    K = random_banded_system(npts, ndofs)
+    Ugood = np.random.uniform(-1, 1, (npts, ndofs, ncases))
+    Ugood[0, :] = 0
+    Fgood = np.einsum("ij,jk->ik", K.toarray(), Ugood.reshape((-1, ncases)))
+    Fgood = Fgood.reshape((npts, ndofs, ncases))
+    Uorig = np.empty((npts, ndofs), dtype="object")
+    Uorig[0, :] = 0
+    Forig = np.copy(Fgood)
+    Forig[0, :] = 0
+    for backend in Factorization.backends:
+        Utest, Ftest = solve(K, Forig, Uorig, backend=backend)
+        assert Utest.shape == (npts, ndofs, ncases)
+        np.testing.assert_almost_equal(Utest, Ugood)
+        np.testing.assert_almost_equal(Ftest, Fgood)
+
+    factor = Factorization(K, backend="banded")
+    B = np.random.uniform(-1, 1, (npts * ndofs, ncases))
+    for j in range(ncases):
+        np.testing.assert_almost_equal(factor.solve(B)[:, j], factor.solve(B[:, j]))
+    with pytest.raises(ValueError):
+        factor.solve(B[1:])
+    with pytest.raises(ValueError):
+        Factorization(K, backend="asd")
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin", "test_sparse_backend"])
+def test_numeric_partition():
+    npts, ndofs = 100, 6
+    K = random_banded_system(npts, ndofs)
+    Ugood = np.random.uniform(-1, 1, (npts, ndofs))
+    Fgood = (K @ Ugood.flatten()).reshape((npts, ndofs))
+    known = np.random.uniform(0, 1, (npts, ndofs)) < 0.2
+    Unan = np.where(known, Ugood, np.nan)
+    Uobj = np.empty((npts, ndofs), dtype="object")
+    Uobj[known] = Ugood[known]
+    Forig = np.where(known, 0, Fgood)
+
+    partition = Partition(known)
+    assert partition == Partition.from_values(Unan)
+    assert partition == Partition.from_values(Uobj)
+    assert partition != Partition(~known)
+    assert partition != known
+    np.testing.assert_equal(partition.known, np.flatnonzero(known))
+    np.testing.assert_equal(partition.unknown, np.flatnonzero(~known))
+    Kkk, Kku, Kuu = partition.split(K)
+    Kdense = K.toarray()
+    np.testing.assert_equal(Kkk.toarray(), Kdense[known.flatten()][:, known.flatten()])
+    np.testing.assert_equal(Kuu.toarray(), partition.split(Kdense)[2])
+
+    for Uorig in [Unan, Uobj]:
+        Utest, Ftest = solve(K, Forig, Uorig)
+        np.testing.assert_almost_equal(Utest, Ugood)
+        np.testing.assert_almost_equal(Ftest, Fgood)
+    Uzero = np.where(known, Ugood, 0)
+    Utest, Ftest = solve(K, Forig, Uzero, partition=partition)
+    np.testing.assert_almost_equal(Utest, Ugood)
+    np.testing.assert_almost_equal(Ftest, Fgood)
+    with pytest.raises(ValueError):
+        Partition(known.flatten())
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin", "test_numeric_partition"])
+def test_mixed_precision():
+    nunk = 300
+    eigvec = np.linalg.qr(np.random.uniform(-1, 1, (nunk, nunk)))[0]
+    for maxeigval, converges in [(1e2, True), (1e12, False)]:
+        eigval = np.logspace(0, np.log10(maxeigval), nunk)
+        Kuu = eigvec @ np.diag(eigval) @ eigvec.T
+        Kuu = (Kuu + Kuu.T) / 2
+        Xgood = np.random.uniform(-1, 1, (nunk, 2))
+        B = Kuu @ Xgood
+        factor = Factorization(Kuu, backend="dense", mixed_precision=True)
+        assert factor.mixed_precision
+        Xtest = factor.solve(B)
+        assert factor.mixed_precision is converges
+        residual = np.linalg.norm(B - Kuu @ Xtest, axis=0) / np.linalg.norm(B, axis=0)
+        assert np.all(residual < 1e-9)
+        if converges:
+            assert factor.iterations > 0
+            np.testing.assert_allclose(Xtest, Xgood)
+
+    npts, ndofs = 50, 6
+    K = random_banded_system(npts, ndofs)
+    Ugood = np.random.uniform(-1, 1, (npts, ndofs))
+    Ugood[0] = 0
+    Fgood = (K @ Ugood.flatten()).reshape((npts, ndofs))
+    Uorig = np.full((npts, ndofs), np.nan)
+    Uorig[0] = 0
+    Forig = np.copy(Fgood)
+    Forig[0] = 0
+    Utest, Ftest = solve(K, Forig, Uorig, backend="dense", mixed_precision=True)
+    np.testing.assert_almost_equal(Utest, Ugood)
+    np.testing.assert_almost_equal(Ftest, Fgood)
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin", "test_numeric_partition"])
+def test_report():
+    npts, ndofs = 100, 6
+    K = random_banded_system(npts, ndofs)
+    Ugood = np.random.uniform(-1, 1, (npts, ndofs))
+    Ugood[0] = 0
+    Fgood = (K @ Ugood.flatten()).reshape((npts, ndofs))
+    Uorig = np.full((npts, ndofs), np.nan)
+    Uorig[0] = 0
+    Forig = np.copy(Fgood)
+    Forig[0] = 0
+    Kuu = K.toarray()[ndofs:, ndofs:]
+    condgood = np.linalg.cond(Kuu, 1)
+    for backend in ["dense", "sparse", "banded"]:
+        _, _, report = solve(K, Forig, Uorig, backend=backend, full_output=True)
+        assert report.backend == backend
+        assert report.size == (npts - 1) * ndofs
+        assert report.nnz == np.count_nonzero(Kuu)
+        assert report.ncases == 1
+        assert report.factorization_time >= 0
+        assert report.solve_time >= 0
+        assert report.residual < 1e-12
+        assert 0.3 * condgood <= report.condition <= 1.01 * condgood
+        assert not report.leastsquare
+        assert report.iterations is None
+        assert "backend" in str(report)
+
+    Ksing = np.zeros((2, 6, 2, 6))  # Truss along x: rotations are free
+    Ksing[:, 0, :, 0] = [[1, -1], [-1, 1]]
+    Uorig = np.full((2, 6), np.nan)
+    Uorig[0] = 0
+    Forig = np.zeros((2, 6))
+    Forig[1, 0] = 1
+    Utest, _, report = solve(Ksing, Forig, Uorig, full_output=True)
+    assert report.leastsquare
+    assert report.condition == float("inf")
+    np.testing.assert_almost_equal(Utest[1], [1, 0, 0, 0, 0, 0])
+
+    Kstiff = np.diag([1, 1, 1, 1e12, 1e12, 1e12])  # Rotations are tiny
+    Uorig, Forig = np.full((1, 6), np.nan), np.ones((1, 6))
+    Utest, _, report = solve(Kstiff, Forig, Uorig, full_output=True)
+    np.testing.assert_allclose(Utest, [[1, 1, 1, 0, 0, 0]])
+    assert report.nclipped == 3
+    assert report.residual < 1e-12
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin", "test_report"])
+def test_lowrank_update():
+    npts, ndofs = 100, 6
+    K = random_banded_system(npts, ndofs)
+    Ugood = np.random.uniform(-1, 1, (npts, ndofs))
+    Ugood[0] = 0
+    Forig = (K @ Ugood.flatten()).reshape((npts, ndofs))
+    Uorig = np.full((npts, ndofs), np.nan)
+    Uorig[0] = 0
+    cache = FactorizationCache()
+    for backend in ["dense", "sparse", "banded"]:
+        cache.clear()
+        _, _, report = solve(
+            K, Forig, Uorig, backend=backend, full_output=True, cache=cache
+        )
+        assert report.lowrank is None
+
+        Utest, _, report = solve(
+            K, Forig, Uorig, backend=backend, full_output=True, cache=cache
+        )
+        assert report.lowrank == 0
+        assert report.backend == backend
+        np.testing.assert_almost_equal(Utest, Ugood)
+
+        Knew = sparse.lil_matrix(K)  # Spring between two dofs of node 50
+        Knew[300, 300] += 3
+        Knew[300, 302] -= 3
+        Knew[302, 300] -= 3
+        Knew[302, 302] += 3
+        Knew = sparse.csr_matrix(Knew)
+        Unew = np.copy(Uorig)
+        Unew[70, 1:4] = 0  # New support on node 70
+        Unewgood, _ = solve(Knew, Forig, Unew)
+        Utest, _, report = solve(
+            Knew, Forig, Unew, backend=backend, full_output=True, cache=cache
+        )
+        assert report.lowrank == 2 + 3
+        assert report.residual < 1e-9
+        np.testing.assert_almost_equal(Utest, Unewgood)
+        assert report.condition > 0
+
+    Unew = np.full((npts, ndofs), np.nan)  # Released support
+    Utest, _, report = solve(
+        Knew, Forig, Unew, backend="banded", full_output=True, cache=cache
+    )
+    assert report.lowrank is None
+    Unewgood, _ = solve(Knew, Forig, Unew, backend="dense")
+    np.testing.assert_almost_equal(Utest, Unewgood)
+
+    with pytest.raises(TypeError):
+        FactorizationCache(maxrank=1.0)
+    with pytest.raises(ValueError):
+        FactorizationCache(maxrank=-1)
+
+
+@pytest.mark.order(1)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin", "test_many_load_cases"])
+def test_batch():
+    nvariants = 5
+    for npts, ndofs in [(6, 6), (100, 6)]:
+        Ks = [random_banded_system(npts, ndofs) for i in range(nvariants)]
+        Uorig = np.full((npts, ndofs), np.nan)
+        Uorig[0] = np.random.uniform(-1, 1, ndofs)
+        Forig = np.random.uniform(-1, 1, (nvariants, npts, ndofs))
+        Ugood, Fgood = [], []
+        for K, F in zip(Ks, Forig):
+            Ui, Fi = solve(K, F, Uorig)
+            Ugood.append(Ui)
+            Fgood.append(Fi)
+        Utest, Ftest = solve_batch(Ks, Forig, Uorig)
+        assert Utest.shape == (nvariants, npts, ndofs)
+        np.testing.assert_almost_equal(Utest, Ugood)
+        np.testing.assert_almost_equal(Ftest, Fgood)
+        Kstack = np.array([K.toarray() for K in Ks])
+        Kstack = Kstack.reshape((nvariants, npts, ndofs, npts, ndofs))
+        Utest, Ftest = solve_batch(Kstack, Forig, Uorig)
+        np.testing.assert_almost_equal(Utest, Ugood)
+        np.testing.assert_almost_equal(Ftest, Fgood)
+
+    Utest, _ = solve_batch(Kstack, Forig[0], Uorig)  # Shared force
+    for K, Ui in zip(Ks, Utest):
+        np.testing.assert_almost_equal(Ui, solve(K, Forig[0], Uorig)[0])
+
+    with pytest.raises(ValueError):
+        solve_batch(Kstack[:, 1:], Forig, Uorig)
+
+
 @pytest.mark.order(1)
 @pytest.mark.dependency(
-    depends=["test_begin", "test_cantilever2pts", "test_random_notsingular_matrix"]
+    depends=[
+        "test_begin",
+        "test_cantilever2pts",
+        "test_random_notsingular_matrix",
+        "test_sparse_backend",
+        "test_banded_backend",
+        "test_cg_backend",
+        "test_many_load_cases",
+        "test_numeric_partition",
+        "test_mixed_precision",
+        "test_report",
+        "test_lowrank_update",
+        "test_batch",
+    ]
 )
 def test_end():
     pass
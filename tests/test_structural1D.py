@@ -2,7 +2,13 @@ import numpy as np
 import pytest
 from compmec.nurbs import GeneratorKnotVector, SplineCurve
 
-from compmec.strct.element import EulerBernoulli, Structural1D
+from compmec.strct.element import (
+    EulerBernoulli,
+    Structural1D,
+    Truss,
+    compute_frames,
+    compute_rvw,
+)
 from compmec.strct.material import Isotropic
 from compmec.strct.profile import Circle
 from compmec.strct.section import CircleSection
@@ -37,6 +43,47 @@ def test_Structural1Dlinearpath():
             np.testing.assert_allclose(ptest, pgood)
 
 
+@pytest.mark.order(5)
+@pytest.mark.timeout(2)
+@pytest.mark.dependency(depends=["test_begin"])
+def test_compute_frames():
+    def rvw_good(p0, p1):
+        r = np.array(p1 - p0) / np.linalg.norm(p1 - p0)
+        v = np.array((0, 0, 1), dtype="float64")
+        if np.abs(np.inner(r, v)) > 0.99:
+            v = np.array((0, 1, 0), dtype="float64")
+        v -= np.inner(r, v) * r
+        v /= np.linalg.norm(v)
+        return np.array([r, np.cross(v, r), v])
+
+    p0s = np.random.uniform(-1, 1, (20, 3))
+    p1s = np.random.uniform(-1, 1, (20, 3))
+    p1s[:5, :2] = p0s[:5, :2]  # Vertical segments
+    frames = compute_frames(p0s, p1s)
+    assert frames.shape == (20, 3, 3)
+    for p0, p1, R33 in zip(p0s, p1s, frames):
+        np.testing.assert_allclose(R33, rvw_good(p0, p1), atol=1e-9)
+        np.testing.assert_allclose(R33 @ R33.T, np.eye(3), atol=1e-9)
+        np.testing.assert_allclose(compute_rvw(p0, p1), R33)
+
+    reference = np.random.uniform(-1, 1, (20, 3))
+    frames = compute_frames(p0s, p1s, reference)
+    for p0, p1, vec, R33 in zip(p0s, p1s, reference, frames):
+        np.testing.assert_allclose(R33 @ R33.T, np.eye(3), atol=1e-9)
+        np.testing.assert_allclose(R33[0], (p1 - p0) / np.linalg.norm(p1 - p0))
+        assert np.inner(R33[1], vec) < 1e-9
+        assert np.inner(R33[2], vec) > 0
+    frames = compute_frames(p0s, p1s, (1, 1, 1))
+    np.testing.assert_allclose(frames[3], compute_rvw(p0s[3], p1s[3], (1, 1, 1)))
+
+    frames = compute_frames([(0, 0), (1, 0)], [(1, 0), (1, 1)])
+    np.testing.assert_allclose(frames[0], [[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    np.testing.assert_allclose(frames[1], [[0, 1, 0], [-1, 0, 0], [0, 0, 1]])
+
+    with pytest.raises(ValueError):
+        compute_frames([(0, 0, 0)], [(0, 0, 1)], (0, 0, 2))
+
+
 class InitBeam(object):
     def create_random_isotropic_material(self):
         E = np.random.uniform(100, 200)
@@ -110,6 +157,8 @@ class TestEulerBernoulli(InitBeam):
 
         with pytest.raises(TypeError):
             self.beam = EulerBernoulli("asd")
+        with pytest.raises(TypeError):
+            self.beam = EulerBernoulli([("0", "0", "0"), (1, 0, 0)])
         with pytest.raises(TypeError):
             self.beam = EulerBernoulli(1)
 
@@ -146,6 +195,163 @@ class TestEulerBernoulli(InitBeam):
         curve = SplineCurve(knotvector, ctrlpoints)
         self.beam = EulerBernoulli(curve)
 
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(2)
+    @pytest.mark.dependency(depends=["TestEulerBernoulli::test_set_from_curve"])
+    def test_segment_stiffness(self):
+        self.create_random_circle_section()
+        knotvector = GeneratorKnotVector.uniform(2, 5)
+        ctrlpoints = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 1), (1, 0, 1)]
+        curve = SplineCurve(knotvector, ctrlpoints)
+        for element in (EulerBernoulli(curve), Truss(curve)):
+            element.section = self.section
+            points = [element.path(ti) for ti in element.ts]
+            Ksegs = element.segment_stiffness_matrices()
+            assert Ksegs.shape == (len(points) - 1, 2, 6, 2, 6)
+            Kgood = np.zeros((len(points), 6, len(points), 6))
+            for i, (p0, p1) in enumerate(zip(points[:-1], points[1:])):
+                L = np.linalg.norm(np.array(p1) - p0)
+                Kloc = element.local_stiffness_matrices([L])[0]
+                R33 = compute_rvw(p0, p1)
+                Kglo = np.zeros((2, 6, 2, 6))
+                for a in range(2):
+                    for b in range(2):
+                        for c in (slice(0, 3), slice(3, 6)):
+                            for d in (slice(0, 3), slice(3, 6)):
+                                Kglo[a, c, b, d] = R33.T @ Kloc[a, c, b, d] @ R33
+                np.testing.assert_allclose(Ksegs[i], Kglo, atol=1e-9)
+                Ktest = element.global_stiffness_matrix(p0, p1)
+                np.testing.assert_allclose(Ktest, Kglo, atol=1e-9)
+                Kgood[i : i + 2, :, i : i + 2, :] += Kglo
+            Ktest = element.stiffness_matrix()
+            np.testing.assert_allclose(Ktest, Kgood, atol=1e-9)
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(2)
+    @pytest.mark.dependency(depends=["TestEulerBernoulli::test_segment_stiffness"])
+    def test_reference(self):
+        self.create_random_circle_section()
+        self.create_beam()
+        self.beam.section = self.section
+        assert self.beam.reference is None
+        np.testing.assert_allclose(self.beam.frames()[0], np.eye(3))
+        Kdefault = self.beam.stiffness_matrix()
+        self.beam.reference = (0, 1, 0)
+        np.testing.assert_allclose(self.beam.reference, (0, 1, 0))
+        good = [[1, 0, 0], [0, 0, -1], [0, 1, 0]]
+        np.testing.assert_allclose(self.beam.frames()[0], good)
+        Ktest = self.beam.stiffness_matrix()
+        np.testing.assert_allclose(Ktest[:, :3, :, :3], Kdefault[:, :3, :, :3])
+        self.beam.reference = None
+        np.testing.assert_allclose(self.beam.stiffness_matrix(), Kdefault)
+
+        with pytest.raises(TypeError):
+            self.beam.reference = "asd"
+        with pytest.raises(ValueError):
+            self.beam.reference = (0, 0)
+        with pytest.raises(ValueError):
+            self.beam.reference = (0, 0, 0)
+        self.beam.reference = (1, 0, 0)
+        with pytest.raises(ValueError):
+            self.beam.stiffness_matrix()
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(2)
+    @pytest.mark.dependency(depends=["TestEulerBernoulli::test_segment_stiffness"])
+    def test_stiffness_cache(self):
+        self.create_random_circle_section()
+        self.create_beam()
+        self.beam.section = self.section
+        Ksegs = self.beam.segment_stiffness_matrices()
+        assert self.beam.segment_stiffness_matrices() is Ksegs
+        with pytest.raises(ValueError):
+            Ksegs[0, 0, 0, 0, 0] = 1
+        np.testing.assert_allclose(
+            self.beam.stiffness_matrix()[0, :, :2, :], Ksegs[0, 0]
+        )
+
+        self.beam.section = self.section  # Same section, recomputes
+        Ktest = self.beam.segment_stiffness_matrices()
+        assert Ktest is not Ksegs
+        np.testing.assert_allclose(Ktest, Ksegs)
+
+        self.create_random_circle_section()
+        Kother = self.beam.segment_stiffness_matrices(self.section)
+        assert self.beam.segment_stiffness_matrices() is Ktest
+        Kother = self.beam.segment_stiffness_matrices((self.material, self.profile))
+        assert self.beam.segment_stiffness_matrices() is Ktest
+        self.beam.section = self.section
+        Ktest = self.beam.segment_stiffness_matrices()
+        assert self.beam.segment_stiffness_matrices(self.section) is Ktest
+        np.testing.assert_allclose(Kother, Ktest)
+        assert not np.allclose(Ktest, Ksegs)
+
+        Ksegs = Ktest
+        self.beam.reference = (0, 1, 0)
+        assert self.beam.segment_stiffness_matrices() is not Ksegs
+
+        Ksegs = self.beam.segment_stiffness_matrices()
+        self.beam.path = [(0, 0, 0), (2, 0, 0)]
+        Ktest = self.beam.segment_stiffness_matrices()
+        np.testing.assert_allclose(Ktest[:, :, 0, :, 0], Ksegs[:, :, 0, :, 0] / 2)
+
+        Ksegs = Ktest
+        self.beam.path.ctrlpoints = np.array([(0, 0, 0), (1, 0, 0)], dtype="float64")
+        Ktest = self.beam.segment_stiffness_matrices()
+        np.testing.assert_allclose(Ktest[:, :, 0, :, 0], 2 * Ksegs[:, :, 0, :, 0])
+        self.beam.path.knot_insert([0.5])
+        Ktest = self.beam.segment_stiffness_matrices()
+        assert Ktest.shape == (2, 2, 6, 2, 6)
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(2)
+    @pytest.mark.dependency(depends=["TestEulerBernoulli::test_set_from_curve"])
+    def test_nodes(self):
+        self.beam = EulerBernoulli([(0, 0, 0), (1, 0, 0), (1, 2, 0)])
+        nodes = self.beam.nodes
+        np.testing.assert_allclose(nodes, [(0, 0, 0), (1, 0, 0), (1, 2, 0)])
+        assert self.beam.nodes is nodes
+        with pytest.raises(ValueError):
+            nodes[0, 0] = 1
+        self.beam.path = [(0, 0, 0), (0, 0, 3)]
+        np.testing.assert_allclose(self.beam.nodes, [(0, 0, 0), (0, 0, 3)])
+
+        knotvector = GeneratorKnotVector.uniform(2, 5)
+        ctrlpoints = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 1), (1, 0, 1)]
+        curve = SplineCurve(knotvector, ctrlpoints)
+        good = curve.evaluate(curve.knotvector.knots)
+        self.beam = EulerBernoulli(curve)
+        nodes = self.beam.nodes
+        assert nodes.shape == (4, 3)
+        np.testing.assert_allclose(nodes, good)
+        assert self.beam.nodes is nodes
+        np.testing.assert_allclose(self.beam.path.evaluate(self.beam.ts), good)
+
+        self.beam.path.knot_insert([0.5])
+        nodes = self.beam.nodes
+        assert nodes.shape == (5, 3)
+        np.testing.assert_allclose(nodes[[0, 1, 3, 4]], good)
+        np.testing.assert_allclose(nodes[2], curve.evaluate(0.5))
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(2)
+    @pytest.mark.dependency(depends=["TestEulerBernoulli::test_creation"])
+    def test_local_stiffness(self):
+        self.create_random_circle_section()
+        self.create_beam()
+        self.beam.section = self.section
+        for L in (0.5, 1, 3):
+            Kx = self.beam.local_stiffness_matrix_Kx(L)
+            Kt = self.beam.local_stiffness_matrix_Kt(L)
+            Ky = self.beam.local_stiffness_matrix_Ky(L)
+            Kz = self.beam.local_stiffness_matrix_Kz(L)
+            K = self.beam.local_stiffness_matrix((0, 0, 0), (L, 0, 0))
+            np.testing.assert_allclose(K[:, 0, :, 0], Kx)
+            np.testing.assert_allclose(K[:, 3, :, 3], Kt)
+            Kyz = K.reshape((12, 12))
+            np.testing.assert_allclose(Kyz[np.ix_([1, 5, 7, 11], [1, 5, 7, 11])], Ky)
+            np.testing.assert_allclose(Kyz[np.ix_([2, 4, 8, 10], [2, 4, 8, 10])], Kz)
+
     @pytest.mark.order(5)
     @pytest.mark.timeout(2)
     @pytest.mark.dependency(
@@ -156,6 +362,11 @@ class TestEulerBernoulli(InitBeam):
             "TestEulerBernoulli::test_fail_creation_class",
             "TestEulerBernoulli::test_fail_set_section",
             "TestEulerBernoulli::test_set_from_curve",
+            "TestEulerBernoulli::test_segment_stiffness",
+            "TestEulerBernoulli::test_local_stiffness",
+            "TestEulerBernoulli::test_reference",
+            "TestEulerBernoulli::test_stiffness_cache",
+            "TestEulerBernoulli::test_nodes",
         ]
     )
     def test_end(self):
@@ -168,6 +379,7 @@ class TestEulerBernoulli(InitBeam):
     depends=[
         "test_begin",
         "test_Structural1Dlinearpath",
+        "test_compute_frames",
         "TestEulerBernoulli::test_end",
     ]
 )
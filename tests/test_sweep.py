@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from compmec.strct.element import EulerBernoulli
+from compmec.strct.material import Isotropic
+from compmec.strct.profile import Circle
+from compmec.strct.sweep import parameter_grid, summarize, sweep
+from compmec.strct.system import StaticSystem
+
+
+def cantilever(diameter: float, E: float, load: float) -> StaticSystem:
+    A, B, C = (0, 0, 0), (500, 0, 0), (1000, 0, 0)
+    beam = EulerBernoulli([A, B, C])
+    beam.section = Isotropic(E=E, nu=0.3), Circle(diameter=diameter)
+    system = StaticSystem()
+    system.add_element(beam)
+    for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+        system.add_BC(A, key, 0)
+    system.add_conc_load(C, "Fy", load)
+    return system
+
+
+def not_a_system(diameter: float) -> float:
+    return diameter
+
+
+@pytest.mark.order(6)
+@pytest.mark.dependency(
+    depends=["tests/test_system.py::test_end"],
+    scope="session",
+)
+def test_begin():
+    pass
+
+
+@pytest.mark.order(6)
+@pytest.mark.timeout(2)
+@pytest.mark.dependency(depends=["test_begin"])
+def test_parameter_grid():
+    grid = parameter_grid({"a": [1, 2], "b": (3, 4, 5)})
+    assert len(grid) == 6
+    assert grid[0] == {"a": 1, "b": 3}
+    assert grid[-1] == {"a": 2, "b": 5}
+    assert parameter_grid({}) == [{}]
+    with pytest.raises(TypeError):
+        parameter_grid([1, 2])
+
+
+@pytest.mark.order(6)
+@pytest.mark.timeout(10)
+@pytest.mark.dependency(depends=["test_begin"])
+def test_summarize():
+    system = cantilever(8, 210e3, -10)
+    with pytest.raises(ValueError):
+        summarize(system)
+    system.run()
+    summary = summarize(system, ["U"])
+    U = system._solution
+    assert summary["max_displacement"] == pytest.approx(np.max(np.abs(U[:, 1])))
+    np.testing.assert_equal(summary["supports"], [(0, 0, 0)])
+    assert summary["reactions"].shape == (1, 6)
+    np.testing.assert_allclose(summary["reactions"][0, 1], 10)
+    np.testing.assert_allclose(summary["reactions"][0, 5], 10000)
+    np.testing.assert_allclose(summary["reactions"][0, [0, 2, 3, 4]], 0, atol=1e-9)
+    np.testing.assert_allclose(summary["U"], U[:, :3], atol=1e-9)
+
+    system.run(renumber=True)
+    renumbered = summarize(system)
+    np.testing.assert_equal(renumbered["supports"], summary["supports"])
+    np.testing.assert_allclose(renumbered["reactions"], summary["reactions"])
+
+
+@pytest.mark.order(6)
+@pytest.mark.timeout(60)
+@pytest.mark.dependency(depends=["test_parameter_grid", "test_summarize"])
+def test_sweep():
+    grid = {"diameter": [6, 8, 10], "E": [70e3, 210e3], "load": [-10, 10]}
+    serial = sweep(cantilever, grid, fields=["U"], max_workers=1)
+    assert len(serial["parameters"]) == 12
+    assert serial["max_displacement"].shape == (12,)
+    assert serial["reactions"].shape == (12, 1, 6)
+    np.testing.assert_equal(serial["supports"], np.zeros((12, 1, 3)))
+    assert serial["U"].shape == (12, 3, 3)
+    for i, parameters in enumerate(serial["parameters"]):
+        system = cantilever(**parameters)
+        system.run()
+        np.testing.assert_allclose(serial["U"][i], system._solution[:, :3])
+
+    parallel = sweep(cantilever, grid, fields=["U"], max_workers=2, chunksize=5)
+    assert parallel["parameters"] == serial["parameters"]
+    for key in ["max_displacement", "reactions", "U"]:
+        np.testing.assert_allclose(parallel[key], serial[key])
+
+    with pytest.raises(TypeError):
+        sweep(1, grid)
+    with pytest.raises(TypeError):
+        sweep(not_a_system, {"diameter": [1]}, max_workers=1)
+
+
+@pytest.mark.order(6)
+@pytest.mark.dependency(
+    depends=["test_begin", "test_parameter_grid", "test_summarize", "test_sweep"]
+)
+def test_end():
+    pass
@@ -1,9 +1,16 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pytest
+from scipy import sparse
 
-from compmec.strct.element import EulerBernoulli
+from compmec.strct.element import EulerBernoulli, Truss
+from compmec.strct.geometry import Point3D
 from compmec.strct.material import Isotropic
 from compmec.strct.profile import Circle
 from compmec.strct.shower import ShowerStaticSystem
+from compmec.strct.solver import bandwidth, solve
 from compmec.strct.system import StaticSystem
 
 
@@ -33,6 +40,8 @@ class TestStaticSystem:
         system = StaticSystem()
         with pytest.raises(ValueError):
             system.run()
+        with pytest.raises(ValueError):
+            system.report
         with pytest.raises(TypeError):
             system.add_element(1)
         with pytest.raises(TypeError):
@@ -78,9 +87,473 @@ class TestStaticSystem:
         with pytest.raises(ValueError):
             system.add_dist_load(beamAB, "Ft", 1)
 
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(2)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_main"])
+    def test_sparse_stiffness(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+        points = [(0, 0, 0), (500, 0, 0), (1000, 0, 0), (1000, 500, 0)]
+        beamAB = EulerBernoulli(points[:3])
+        beamBC = EulerBernoulli(points[2:])
+        beamAB.section = steel, circle
+        beamBC.section = steel, circle
+        system = StaticSystem()
+        system.add_element(beamAB)
+        system.add_element(beamBC)
+        system.add_BC(points[0], "Ux", 0)
+        system.add_BC(points[0], "Uy", 0)
+        system.add_BC(points[0], "Uz", 0)
+        system.add_BC(points[0], "tx", 0)
+        system.add_BC(points[0], "ty", 0)
+        system.add_BC(points[0], "tz", 0)
+        system.add_conc_load(points[3], "Fz", 1)
+        system.run()
+        assert system.report.backend == "dense"
+        assert system.report.size == 18
+        assert system.report.residual < 1e-9
+        assert system.report.condition is None
+        assert system.report.factorization_time >= 0
+        system.run(condition=True)
+        assert system.report.condition >= 1
+
+        K = system.mount_K()
+        assert sparse.issparse(K)
+        assert K.shape == (24, 24)
+        Kgood = np.zeros((4, 6, 4, 6))
+        Kgood[:3, :, :3, :] += beamAB.stiffness_matrix()
+        Kgood[2:, :, 2:, :] += beamBC.stiffness_matrix()
+        np.testing.assert_allclose(K.toarray(), Kgood.reshape((24, 24)))
+        assert K.nnz < 24 * 24
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_sparse_stiffness"])
+    def test_renumber(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+        nbeams = 20
+        points = [(100 * i, 10 * i**2, 0) for i in range(nbeams + 1)]
+        order = np.random.permutation(nbeams)
+        beams = [EulerBernoulli(points[i : i + 2]) for i in range(nbeams)]
+        system = StaticSystem()
+        for i in order:  # Points are added in a random order
+            beams[i].section = steel, circle
+            system.add_element(beams[i])
+        for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+            system.add_BC(points[0], key, 0)
+        system.add_conc_load(points[-1], "Fz", 1)
+        system.add_conc_load(points[-1], "Fx", 1)
+
+        system.run(renumber=False)
+        Ugood = [beam.field("U").ctrlpoints for beam in beams]
+        bandgood = bandwidth(system.mount_K())
+        system.run(renumber=True)
+        Utest = [beam.field("U").ctrlpoints for beam in beams]
+        bandtest = bandwidth(system.mount_K())
+        np.testing.assert_allclose(Utest, Ugood)
+        assert bandtest <= 11
+        assert bandtest <= bandgood
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_sparse_stiffness"])
+    def test_load_cases(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+        A, B, C = (0, 0, 0), (500, 0, 0), (1000, 0, 0)
+        beam = EulerBernoulli([A, B, C])
+        beam.section = steel, circle
+        cases = {
+            "tip": [(C, "Fy", -10)],
+            "middle": [(B, "Fz", 20), (B, "Mx", 3)],
+            "both": [(C, "Fy", -10), (B, "Fz", 20), (B, "Mx", 3)],
+        }
+        system = StaticSystem()
+        system.add_element(beam)
+        for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+            system.add_BC(A, key, 0)
+        system.add_conc_load(C, "Fx", 5)
+        results = system.run_load_cases(cases)
+        assert tuple(results.keys()) == tuple(cases.keys())
+
+        for name, loads in cases.items():
+            system = StaticSystem()
+            system.add_element(beam)
+            for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+                system.add_BC(A, key, 0)
+            system.add_conc_load(C, "Fx", 5)
+            for point, key, value in loads:
+                system.add_conc_load(point, key, value)
+            system.run()
+            np.testing.assert_allclose(results[name]["U"], system._solution)
+            fieldtest = results[name]["fields"][0]("U").ctrlpoints
+            fieldgood = beam.field("U").ctrlpoints
+            np.testing.assert_allclose(fieldtest, fieldgood)
+        Uboth = results["tip"]["U"] + results["middle"]["U"] - results["both"]["U"]
+        Fboth = results["tip"]["F"] + results["middle"]["F"] - results["both"]["F"]
+        np.testing.assert_allclose(Uboth[:, 1:], 0, atol=1e-9)
+        np.testing.assert_allclose(Fboth[0, 1:], 0, atol=1e-9)
+
+        with pytest.raises(TypeError):
+            system.run_load_cases([(C, "Fy", -10)])
+        with pytest.raises(ValueError):
+            system.run_load_cases({})
+        with pytest.raises(ValueError):
+            system.run_load_cases({"wrong": [(C, "Fw", -10)]})
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_load_cases"])
+    def test_lowrank_update(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        thin, thick = Circle(diameter=8), Circle(diameter=12)
+        points = [(100 * i, 0, 0) for i in range(11)]
+        beams = [EulerBernoulli([P, Q]) for P, Q in zip(points[:-1], points[1:])]
+        for beam in beams:
+            beam.section = steel, thin
+        system = StaticSystem()
+        for beam in beams:
+            system.add_element(beam)
+        for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+            system.add_BC(points[0], key, 0)
+        system.add_conc_load(points[-1], "Fy", -10)
+        system.add_conc_load(points[5], "Fz", 20)
+        system.run(backend="dense")
+        assert system.report.lowrank is None
+        partition = system.mount_partition()
+        assert system._partition is partition
+        assert system.mount_partition() is partition
+        Utest = system.mount_U()
+        np.testing.assert_equal(partition.known, np.flatnonzero(~np.isnan(Utest)))
+
+        beams[3].section = steel, thick
+        system.add_BC(points[7], "Uz", 0)
+        assert system.mount_partition() is not partition
+        partition = system.mount_partition()
+        assert len(partition.known) == 7
+        system.run(backend="dense")
+        assert system._partition is partition
+        assert system.report.lowrank == 12 + 1
+        Ugood, _ = solve(system.mount_K(), system.mount_F(), system.mount_U())
+        np.testing.assert_allclose(system._solution, Ugood, atol=1e-9)
+
+        system.run(backend="sparse")
+        assert system.report.lowrank is None
+        np.testing.assert_allclose(system._solution, Ugood, atol=1e-9)
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_sparse_stiffness"])
+    def test_variants(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        aluminum = Isotropic(E=70e3, nu=0.33)
+        points = [(100 * i, 0, 0) for i in range(11)]
+        beams = [EulerBernoulli([P, Q]) for P, Q in zip(points[:-1], points[1:])]
+        for beam in beams:
+            beam.section = steel, Circle(diameter=8)
+        variants = [{}, {beams[2]: (aluminum, Circle(diameter=8))}]
+        variants += [{beams[0]: (steel, Circle(diameter=d))} for d in (6, 10, 12)]
+        variants.append({beam: (aluminum, Circle(diameter=10)) for beam in beams})
+        original = [beam.section for beam in beams]
+
+        def new_system():
+            system = StaticSystem()
+            for beam in beams:
+                system.add_element(beam)
+            for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+                system.add_BC(points[0], key, 0)
+            system.add_conc_load(points[-1], "Fy", -10)
+            system.add_conc_load(points[5], "Mx", 30)
+            return system
+
+        cached = [beam.segment_stiffness_matrices() for beam in beams]
+        varsystem = new_system()
+        Utest, Ftest = varsystem.run_variants(variants)
+        assert Utest.shape == (len(variants), len(points), 6)
+        assert [beam.section for beam in beams] == original
+        for beam, Ksegs in zip(beams, cached):
+            assert beam.segment_stiffness_matrices() is Ksegs
+        names = ("FI", "FE", "MI", "ME")
+        for variant, Ui, Fi in zip(variants, Utest, Ftest):
+            fields = varsystem.compute_fields(Ui, variant)
+            values = [[field(name).ctrlpoints for name in names] for field in fields]
+            for beam, section in variant.items():
+                beam.section = section
+            system = new_system()
+            system.run()
+            np.testing.assert_allclose(Ui, system._solution, atol=1e-9)
+            for beam, good in zip(beams, values):
+                for name, value in zip(names, good):
+                    goodvalue = beam.field(name).ctrlpoints
+                    np.testing.assert_allclose(value, goodvalue, atol=1e-6)
+            for beam, section in zip(beams, original):
+                beam.section = section
+
+        with pytest.raises(TypeError):
+            new_system().run_variants([(steel, Circle(diameter=8))])
+        with pytest.raises(ValueError):
+            new_system().run_variants([{EulerBernoulli([(0, 0, 0), (0, 0, 1)]): None}])
+        with pytest.raises(TypeError):
+            varsystem.compute_fields(Utest[0], [(steel, Circle(diameter=8))])
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_main"])
+    def test_registry(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+        nglobal = len(Point3D.registry)
+        for i in range(20):
+            A, B = (0, 0, i), (1000, 0, i)
+            beam = EulerBernoulli([A, B])
+            beam.section = steel, circle
+            system = StaticSystem()
+            system.add_element(beam)
+            for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+                system.add_BC(A, key, 0)
+            system.add_conc_load(B, "Fy", -10)
+            system.run()
+            assert len(system._registry) == 2
+        assert len(Point3D.registry) == nglobal
+
+        system.clear()
+        assert len(system._registry) == 0
+        assert system._geometry.npts == 0
+        with pytest.raises(ValueError):
+            system.run()
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_renumber"])
+    def test_connectivity(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+        A, B, C, D = (0, 0, 0), (500, 0, 0), (1000, 0, 0), (500, 500, 0)
+        beamAC = EulerBernoulli([A, B, C])
+        beamBD = EulerBernoulli([B, D])
+        system = StaticSystem()
+        for beam in (beamAC, beamBD):
+            beam.section = steel, circle
+            system.add_element(beam)
+        connectivity = system.mount_connectivity()
+        assert len(connectivity) == 2
+        np.testing.assert_equal(connectivity[0], [0, 1, 2])
+        np.testing.assert_equal(connectivity[1], [1, 3])
+        assert system.mount_connectivity() is connectivity
+
+        beamCD = EulerBernoulli([C, D])
+        beamCD.section = steel, circle
+        system.add_element(beamCD)
+        connectivity = system.mount_connectivity()
+        np.testing.assert_equal(connectivity[2], [2, 3])
+        system.renumber_points()
+        for beam, nodes in zip((beamAC, beamBD, beamCD), system.mount_connectivity()):
+            for t, node in zip(beam.ts, nodes):
+                assert system._geometry.find_point(beam.path(t)) == node
+
+        nbeams = 2000
+        system = StaticSystem()
+        for i in range(nbeams):
+            beam = EulerBernoulli([(i, 0, 0), (i + 1, 0, 0)])
+            beam.section = steel, circle
+            system.add_element(beam)
+        connectivity = system.mount_connectivity()
+        assert system._geometry.npts == nbeams + 1
+        np.testing.assert_equal(connectivity, [(i, i + 1) for i in range(nbeams)])
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_connectivity"])
+    def test_path_change(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+        A, B, C = (0, 0, 0), (500, 0, 0), (1000, 0, 0)
+        beam = EulerBernoulli([A, B, C])
+        beam.section = steel, circle
+        system = StaticSystem()
+        system.add_element(beam)
+        for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+            system.add_BC(A, key, 0)
+        system.add_conc_load(B, "Fy", -10)
+        system.run()
+
+        beam.path = [A, B]
+        system.run()
+        np.testing.assert_equal(system.mount_connectivity(), [(0, 1)])
+        assert system._geometry.npts == 2
+        other = EulerBernoulli([A, B])
+        other.section = steel, circle
+        good = StaticSystem()
+        good.add_element(other)
+        for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+            good.add_BC(A, key, 0)
+        good.add_conc_load(B, "Fy", -10)
+        good.run()
+        np.testing.assert_allclose(system._solution, good._solution)
+
+        beam.path = [A, C]
+        with pytest.raises(ValueError):
+            system.run()  # The load is on B, which is not a node anymore
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_path_change"])
+    def test_tolerance(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+        npts = 21
+        Uends = []
+        for scale in (1, 1e-3):  # millimeters and meters
+            points = [(scale * 100 * i / (npts - 1), 0, 0) for i in range(npts)]
+            beam = EulerBernoulli(points)
+            beam.section = steel, circle
+            system = StaticSystem()
+            assert system.tolerance == 1e-3
+            system.add_element(beam)
+            system.set_tolerance(1e-6, relative=True)
+            assert abs(system.tolerance - scale * 1e-4) < 1e-12
+            for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+                system.add_BC(points[0], key, 0)
+            system.add_conc_load(points[-1], "Fx", 10)
+            system.run()
+            assert system._geometry.npts == npts
+            Uends.append(system._solution[-1, 0] / scale)
+        np.testing.assert_allclose(Uends[0], Uends[1])
+
+        system = StaticSystem()
+        system.set_tolerance(0.5)
+        assert system.tolerance == 0.5
+        with pytest.raises(ValueError):
+            system.set_tolerance(1e-9, relative=True)
+        with pytest.raises(TypeError):
+            system.set_tolerance("asd")
+        with pytest.raises(ValueError):
+            system.set_tolerance(-1)
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(20)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_main"])
+    def test_independent(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+
+        def build(load: float) -> StaticSystem:
+            A, B, C = (0, 0, 0), (500, 0, 0), (1000, 0, 0)
+            beam = EulerBernoulli([A, B, C])
+            beam.section = steel, circle
+            system = StaticSystem()
+            system.add_element(beam)
+            for key in ["Ux", "Uy", "Uz", "tx", "ty", "tz"]:
+                system.add_BC(A, key, 0)
+            system.add_conc_load(C, "Fy", load)
+            return system
+
+        first, second = build(-10), build(20)
+        assert first is not second
+        first.run()
+        second.run()
+        np.testing.assert_allclose(second._solution, -2 * first._solution)
+
+        def analysis(load: float) -> np.ndarray:
+            system = build(load)
+            system.run()
+            return system._solution
+
+        loads = np.linspace(-50, 50, 16)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            solutions = list(executor.map(analysis, loads))
+        for load, solution in zip(loads, solutions):
+            np.testing.assert_allclose(solution, (load / -10) * first._solution)
+
+        copy = pickle.loads(pickle.dumps(first))
+        assert copy is not first
+        np.testing.assert_allclose(copy._solution, first._solution)
+        copy.add_conc_load((1000, 0, 0), "Fy", -10)
+        copy.run()
+        np.testing.assert_allclose(copy._solution, 2 * first._solution)
+
+    @pytest.mark.order(5)
+    @pytest.mark.timeout(10)
+    @pytest.mark.dependency(depends=["TestStaticSystem::test_load_cases"])
+    def test_truss(self):
+        steel = Isotropic(E=210e3, nu=0.3)
+        circle = Circle(diameter=8)
+        supports = [(0, 0, 0), (1000, 0, 0), (0, 1000, 0)]
+        apex = (300, 300, 800)
+        trusses = [Truss([support, apex]) for support in supports]
+        system = StaticSystem()
+        for truss in trusses:
+            truss.section = steel, circle
+            system.add_element(truss)
+        for support in supports:
+            for key in ["Ux", "Uy", "Uz", "tx"]:
+                system.add_BC(support, key, 0)
+        system.add_conc_load(apex, "Fx", 50)
+        system.add_conc_load(apex, "Fz", -1000)
+        assert system.ndofs == 3
+        system.run()
+        assert system.report.size == 3
+        assert not system.report.leastsquare
+        assert system.mount_K().shape == (12, 12)
+        U, F = system._solution, system._forces
+        assert U.shape == (4, 6)
+        np.testing.assert_allclose(U[:, 3:], 0)
+        np.testing.assert_allclose(np.sum(F, axis=0), 0, atol=1e-9)
+
+        # Same solution with the 6 dofs, fixing all rotations
+        index = [system._registry.get_index(Point3D(point)) for point in supports]
+        index = system._geometry.local_indexs(index)
+        Kgood = np.zeros((4, 6, 4, 6))
+        for truss, nodes in zip(trusses, system.mount_connectivity()):
+            Kgood[np.ix_(nodes, range(6), nodes, range(6))] += truss.stiffness_matrix()
+        Ugood = np.full((4, 6), np.nan)
+        Ugood[:, 3:] = 0
+        Ugood[index, :3] = 0
+        Fgood = np.zeros((4, 6))
+        Fgood[:, :3] = F[:, :3]
+        Fgood[index] = 0
+        Ugood, Fgood = solve(Kgood, Fgood, Ugood)
+        np.testing.assert_allclose(U, Ugood, atol=1e-9)
+        np.testing.assert_allclose(F, Fgood, atol=1e-9)
+
+        case = [(apex, "Fx", -100), (apex, "Fz", 2000)]
+        results = system.run_load_cases({"up": case})
+        np.testing.assert_allclose(results["up"]["U"], -U, atol=1e-9)
+        Uvar, Fvar = system.run_variants([{}, {trusses[0]: (steel, circle)}])
+        assert Uvar.shape == (2, 4, 6)
+        np.testing.assert_allclose(Uvar[0], U, atol=1e-9)
+        np.testing.assert_allclose(Fvar[1], F, atol=1e-9)
+
+        system.add_conc_load(apex, "Mx", 10)
+        with pytest.raises(ValueError):
+            system.run()
+
+        system = StaticSystem()
+        for truss in trusses:
+            system.add_element(truss)
+        beam = EulerBernoulli([apex, (300, 300, 1000)])
+        beam.section = steel, circle
+        system.add_element(beam)
+        assert system.ndofs == 6
+
     @pytest.mark.order(5)
     @pytest.mark.dependency(
-        depends=["TestStaticSystem::test_begin", "TestStaticSystem::test_main"]
+        depends=[
+            "TestStaticSystem::test_begin",
+            "TestStaticSystem::test_main",
+            "TestStaticSystem::test_sparse_stiffness",
+            "TestStaticSystem::test_renumber",
+            "TestStaticSystem::test_load_cases",
+            "TestStaticSystem::test_lowrank_update",
+            "TestStaticSystem::test_variants",
+            "TestStaticSystem::test_registry",
+            "TestStaticSystem::test_connectivity",
+            "TestStaticSystem::test_path_change",
+            "TestStaticSystem::test_tolerance",
+            "TestStaticSystem::test_independent",
+            "TestStaticSystem::test_truss",
+        ]
     )
     def test_end(self):
         pass